@@ -0,0 +1,64 @@
+"""
+Archiv für Schülerdaten inaktiver Jahrgänge.
+
+Jede Datenbank bekommt eine zweite Datei (<name>.archiv.db), die als Schema
+'archiv' an jede Verbindung angehängt wird. Beim Deaktivieren eines Jahrgangs
+wandern seine Zeilen stapelweise dorthin, beim Aktivieren zurück. So bleibt
+die Tabelle schueler_daten klein; die Sicht alle_schueler_daten liefert
+beide Bereiche zusammen für Export und Suche.
+
+Das Verschieben selbst steht in speicher.py, weil PostgreSQL dieselbe Logik
+mit einer Archivtabelle statt einer angehängten Datei nutzt.
+"""
+
+import os
+
+ARCHIV_BATCH = 500
+
+SPALTEN = ('id, jahrgang_id, vorname, nachname, email, '
+           'datenschutz_einwilligung, datenschutz_datum, erstellt_am, widerrufen_am')
+
+
+def archiv_pfad(pfad):
+    """database.db -> database.archiv.db (kein gültiger Mandantenname)"""
+    return os.path.splitext(pfad)[0] + '.archiv.db'
+
+
+def anhaengen(conn, pfad):
+    """Archiv an eine frische Verbindung anhängen und Sicht anlegen"""
+    conn.execute('ATTACH DATABASE ? AS archiv', (archiv_pfad(pfad),))
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archiv.schueler_daten (
+            id INTEGER PRIMARY KEY,
+            jahrgang_id INTEGER NOT NULL,
+            vorname TEXT NOT NULL,
+            nachname TEXT NOT NULL,
+            email TEXT NOT NULL,
+            datenschutz_einwilligung BOOLEAN NOT NULL DEFAULT 1,
+            datenschutz_datum TIMESTAMP,
+            erstellt_am TIMESTAMP,
+            widerrufen_am TIMESTAMP
+        )
+    ''')
+    # Archivdateien älterer Versionen: Spalte nachrüsten wie schema._migration_5
+    spalten = [zeile[1] for zeile in conn.execute('PRAGMA archiv.table_info(schueler_daten)')]
+    if 'widerrufen_am' not in spalten:
+        conn.execute('ALTER TABLE archiv.schueler_daten ADD COLUMN widerrufen_am TIMESTAMP')
+        conn.execute('''
+            UPDATE archiv.schueler_daten SET widerrufen_am = datenschutz_datum, datenschutz_datum = erstellt_am
+            WHERE NOT datenschutz_einwilligung
+        ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS archiv.idx_archiv_jahrgang ON schueler_daten (jahrgang_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archiv.idx_archiv_datenschutz ON schueler_daten (datenschutz_datum)')
+    conn.execute("CREATE INDEX IF NOT EXISTS archiv.idx_archiv_nicht_anonym ON schueler_daten (datenschutz_datum) "
+                 "WHERE email <> ''")
+    conn.execute('CREATE INDEX IF NOT EXISTS archiv.idx_archiv_widerrufen ON schueler_daten (widerrufen_am)')
+    conn.execute("CREATE INDEX IF NOT EXISTS archiv.idx_archiv_widerrufen_nicht_anonym ON schueler_daten (widerrufen_am) "
+                 "WHERE email <> ''")
+    conn.execute(f'''
+        CREATE TEMP VIEW IF NOT EXISTS alle_schueler_daten AS
+        SELECT {SPALTEN}, 0 AS archiviert FROM main.schueler_daten
+        UNION ALL
+        SELECT {SPALTEN}, 1 AS archiviert FROM archiv.schueler_daten
+    ''')
+    conn.commit()
@@ -0,0 +1,129 @@
+"""
+Aufbewahrung: Löschen oder Anonymisieren nach Ablauf der Einwilligung.
+
+Regeln stehen in AUFBEWAHRUNG_REGELN, durch Komma getrennt, jeweils
+<bedingung>=<zahl>:<aktion>:
+
+- jahre=5:anonymisieren — Einwilligung (datenschutz_datum) älter als 5 Jahre
+- widerrufen=30:loeschen — Einwilligung seit mehr als 30 Tagen widerrufen (widerrufen_am)
+  (widerrufen:loeschen ohne Zahl = sofort)
+
+Aktionen sind loeschen und anonymisieren. Ohne Regeln passiert nichts.
+Gearbeitet wird in kleinen Stapeln mit je eigener Transaktion und kurzer
+Pause dazwischen, damit die Schreibsperre nie lange gehalten wird.
+"""
+
+import datetime
+import os
+import time
+
+import speicher
+
+AUFBEWAHRUNG_BATCH = int(os.environ.get('AUFBEWAHRUNG_BATCH', '200'))
+AUFBEWAHRUNG_PAUSE = float(os.environ.get('AUFBEWAHRUNG_PAUSE', '0.05'))  # Sekunden zwischen Stapeln
+# 0 = kein automatischer Lauf, nur über die Admin-Seite
+AUFBEWAHRUNG_INTERVALL_STUNDEN = float(os.environ.get('AUFBEWAHRUNG_INTERVALL_STUNDEN', '24'))
+
+BEDINGUNGEN = ('jahre', 'widerrufen')
+AKTION_TEXTE = {'loeschen': 'Löschen', 'anonymisieren': 'Anonymisieren'}
+
+
+class Regel:
+    """Eine Aufbewahrungsregel, z. B. jahre=5:anonymisieren"""
+
+    def __init__(self, bedingung, zahl, aktion):
+        if bedingung not in BEDINGUNGEN:
+            raise ValueError(f'Unbekannte Bedingung: {bedingung!r} (erlaubt: {", ".join(BEDINGUNGEN)})')
+        if aktion not in speicher.AUFBEWAHRUNG_AKTIONEN:
+            raise ValueError(f'Unbekannte Aktion: {aktion!r} (erlaubt: {", ".join(speicher.AUFBEWAHRUNG_AKTIONEN)})')
+        if zahl < 0 or (bedingung == 'jahre' and zahl == 0):
+            raise ValueError(f'Ungültige Frist für {bedingung}: {zahl}')
+        self.bedingung = bedingung
+        self.zahl = zahl
+        self.aktion = aktion
+
+    @property
+    def widerrufen(self):
+        return self.bedingung == 'widerrufen'
+
+    @property
+    def name(self):
+        return f'{self.bedingung}={self.zahl}:{self.aktion}'
+
+    def beschreibung(self):
+        aktion = AKTION_TEXTE[self.aktion]
+        if self.widerrufen:
+            frist = f'{self.zahl} Tage nach' if self.zahl else 'sofort nach'
+            return f'{aktion} {frist} Widerruf der Einwilligung'
+        return f'{aktion} {self.zahl} Jahre nach der Einwilligung'
+
+    def stichtag(self, jetzt=None):
+        """Einträge mit Datum vor diesem Zeitpunkt sind fällig (UTC, wie alle gespeicherten Zeitpunkte)"""
+        jetzt = jetzt or datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if self.widerrufen:
+            grenze = jetzt - datetime.timedelta(days=self.zahl)
+        else:
+            try:
+                grenze = jetzt.replace(year=jetzt.year - self.zahl)
+            except ValueError:  # 29. Februar
+                grenze = jetzt.replace(year=jetzt.year - self.zahl, day=28)
+        return grenze.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def regeln_lesen(text):
+    """'jahre=5:anonymisieren,widerrufen:loeschen' -> [Regel, ...]"""
+    regeln = []
+    for teil in text.split(','):
+        teil = teil.strip().lower()
+        if not teil:
+            continue
+        bedingung, trenner, aktion = teil.partition(':')
+        if not trenner:
+            raise ValueError(f'Regel ohne Aktion: {teil!r}')
+        bedingung, _, zahl = bedingung.partition('=')
+        try:
+            zahl = int(zahl) if zahl else 0
+        except ValueError:
+            raise ValueError(f'Frist ist keine Zahl: {teil!r}') from None
+        regeln.append(Regel(bedingung.strip(), zahl, aktion.strip()))
+    return regeln
+
+
+REGELN = regeln_lesen(os.environ.get('AUFBEWAHRUNG_REGELN', ''))
+
+
+def ausfuehren(db, regeln=None, probelauf=False, batch=None, pause=None, jetzt=None):
+    """
+    Wendet die Regeln der Reihe nach auf aktive und archivierte Einträge an.
+
+    Gibt je Regel ein dict mit den Anzahlen zurück. Im Probelauf wird nur
+    gezählt; ein Eintrag kann dann unter mehrere Regeln fallen.
+    """
+    regeln = REGELN if regeln is None else regeln
+    batch = batch or AUFBEWAHRUNG_BATCH
+    pause = AUFBEWAHRUNG_PAUSE if pause is None else pause
+
+    ergebnis = []
+    for regel in regeln:
+        stichtag = regel.stichtag(jetzt)
+        if probelauf:
+            anzahl = db.aufbewahrung_zaehlen(regel.widerrufen, stichtag, regel.aktion)
+        else:
+            anzahl = {}
+            for bereich in ('schueler', 'archiv'):
+                anzahl[bereich] = 0
+                while True:
+                    bearbeitet = db.aufbewahrung_stapel(
+                        bereich, regel.name, regel.widerrufen, stichtag, regel.aktion, batch)
+                    anzahl[bereich] += bearbeitet
+                    if bearbeitet < batch:
+                        break
+                    time.sleep(pause)
+        ergebnis.append({
+            'regel': regel.name,
+            'beschreibung': regel.beschreibung(),
+            'stichtag': stichtag,
+            'aktiv': anzahl['schueler'],
+            'archiviert': anzahl['archiv'],
+        })
+    return ergebnis
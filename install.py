@@ -1,16 +1,20 @@
 """
 Dieses Script:
 - Installiert alle nötigen Abhängigkeiten
-- Setzt die Datenbank auf
+- Setzt die Datenbank auf (SQLite oder mit SPEICHER=postgres PostgreSQL)
+- Richtet mit --mandant NAME weitere Schulen (Mandanten) ein
 """
 
+import argparse
 import os
 import sys
 import subprocess
-import sqlite3
 import hashlib
 from pathlib import Path
 
+import mandanten
+import speicher
+
 # Farben für die Konsole
 class Colors:
     HEADER = '\033[95m'
@@ -79,6 +83,8 @@ def install_dependencies():
     print_info("Installiere Python-Abhängigkeiten...")
     
     requirements = ["flask"]
+    if speicher.SPEICHER == 'postgres':
+        requirements.append("psycopg2-binary")
     
     for package in requirements:
         try:
@@ -93,70 +99,26 @@ def install_dependencies():
 
 
 
-def setup_database():
-    """Initialisiert die SQLite-Datenbank"""
-    print_info("Initialisiere Datenbank...")
+def datenbank_name(mandant=None):
+    """Datei bzw. Schema eines Mandanten für Meldungen"""
+    if speicher.SPEICHER == 'postgres':
+        return f"Schema {speicher.postgres_schema(mandant)}"
+    return speicher.sqlite_pfad(mandant)
+
+
+def setup_database(mandant=None):
+    """Initialisiert die Datenbank (Einzelbetrieb oder Mandant)"""
+    print_info(f"Initialisiere Datenbank {datenbank_name(mandant)}...")
     
     try:
-        conn = sqlite3.connect('database.db')
-        cursor = conn.cursor()
-        
-        # Prüfe ob die Tabelle bereits existiert und füge fehlende Spalten hinzu
-        try:
-            # Prüfe ob datenschutz_datum Spalte existiert
-            cursor.execute("PRAGMA table_info(schueler_daten)")
-            columns = [column[1] for column in cursor.fetchall()]
-            
-            # Füge fehlende Spalten hinzu falls sie nicht existieren
-            if 'datenschutz_einwilligung' not in columns:
-                cursor.execute('ALTER TABLE schueler_daten ADD COLUMN datenschutz_einwilligung BOOLEAN NOT NULL DEFAULT 1')
-            
-            if 'datenschutz_datum' not in columns:
-                cursor.execute('ALTER TABLE schueler_daten ADD COLUMN datenschutz_datum TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
-                
-        except sqlite3.OperationalError:
-            # Tabelle existiert noch nicht, wird unten erstellt
-            pass
-        
-        # Tabelle für Abitur-Jahrgänge
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS abitur_jahrgaenge (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                jahrgang INTEGER UNIQUE NOT NULL,
-                aktiv BOOLEAN DEFAULT 1
-            )
-        ''')
+        db = speicher.erstellen(mandant)
+        alte_version, neue_version = db.schema_aktualisieren()
+        if alte_version != neue_version:
+            print_info(f"Schema von Version {alte_version} auf {neue_version} aktualisiert")
         
-        # Tabelle für Schülerdaten
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS schueler_daten (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                jahrgang_id INTEGER NOT NULL,
-                vorname TEXT NOT NULL,
-                nachname TEXT NOT NULL,
-                email TEXT NOT NULL,
-                datenschutz_einwilligung BOOLEAN NOT NULL DEFAULT 1,
-                datenschutz_datum TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                erstellt_am TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (jahrgang_id) REFERENCES abitur_jahrgaenge (id)
-            )
-        ''')
-        
-        # Admin-Tabelle
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                benutzername TEXT UNIQUE NOT NULL,
-                passwort_hash TEXT NOT NULL
-            )
-        ''')
         # Standard-Login erstellen (admin/password)
         admin_passwort = hashlib.sha256('password'.encode()).hexdigest()
-        cursor.execute('INSERT OR IGNORE INTO admins (benutzername, passwort_hash) VALUES (?, ?)', 
-                       ('admin', admin_passwort))
-        
-        conn.commit()
-        conn.close()
+        db.admin_anlegen_falls_fehlend('admin', admin_passwort)
         
         print_success("Datenbank initialisiert")
         print_success("Admin-Benutzer erstellt: admin/password")
@@ -168,9 +130,46 @@ def setup_database():
         return False
 
 
+def setup_mandant(name):
+    """Legt die Datenbank für einen neuen Mandanten (Schule) an"""
+    if not mandanten.gueltiger_mandant(name):
+        print_error(f"Ungültiger Mandantenname '{name}' (erlaubt: a-z, 0-9, '-' und '_')")
+        return False
+    
+    if speicher.SPEICHER == 'sqlite':
+        os.makedirs(mandanten.MANDANTEN_VERZEICHNIS, exist_ok=True)
+    try:
+        if name in speicher.alle_mandanten():
+            print_warning(f"Mandant '{name}' existiert bereits, Schema wird aktualisiert")
+    except Exception as e:
+        print_error(f"Datenbank nicht erreichbar: {e}")
+        return False
+    
+    if not setup_database(name):
+        return False
+    
+    print_success(f"Mandant '{name}' eingerichtet: {datenbank_name(name)}")
+    return True
+
+
 def main():
     """Hauptfunktion des Installationsscripts"""
+    parser = argparse.ArgumentParser(description="Installation der Ehemaligen-Datenerfassung")
+    parser.add_argument('--mandant', action='append', default=[], metavar='NAME',
+                        help="Neue Schule (Mandant) einrichten, mehrfach angebbar")
+    args = parser.parse_args()
+    
     print_ascii()
+    
+    if args.mandant:
+        print_header("MANDANTEN EINRICHTEN")
+        fehlgeschlagen = [name for name in args.mandant if not setup_mandant(name)]
+        if fehlgeschlagen:
+            print_error(f"❌ Fehlgeschlagen: {', '.join(fehlgeschlagen)}")
+            sys.exit(1)
+        print_info("Starte main.py mit MANDANTEN_MODUS=host oder MANDANTEN_MODUS=pfad.")
+        return
+    
     print_header("INSTALLATION")
     
     print_info("Dieses Script installiert Abhängigkeiten und setzt die Datenbank auf.")
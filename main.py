@@ -1,20 +1,212 @@
 import flask
-import sqlite3
 import hashlib
 import datetime
 import csv
 import io
+import os
 import secrets
+import threading
+import time
+
+import aufbewahrung
+import mandanten
+import schutz
+import speicher
 
 app = flask.Flask(__name__)
-app.secret_key = secrets.token_urlsafe(48)
-DATABASE = 'database.db'
+# Signiert Sitzungen und Formular-Token; bei mehreren Prozessen oder Servern
+# muss SECRET_KEY überall gleich sein
+app.secret_key = os.environ.get('SECRET_KEY') or secrets.token_urlsafe(48)
+if not os.environ.get('SECRET_KEY'):
+    print('SECRET_KEY nicht gesetzt, verwende zufälligen Schlüssel (nur für einen einzelnen Prozess geeignet)')
+# Obergrenze für alle Anfragen (Sammelaktionen mit vielen ids); /submit
+# setzt für sich die viel kleineren SUBMIT_MAX_* (siehe submit_data)
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+app.config['MAX_FORM_MEMORY_SIZE'] = 1024 * 1024
+app.wsgi_app = mandanten.MandantenMiddleware(app.wsgi_app, existiert=speicher.mandant_existiert)
+
+# Ratenbegrenzung für /submit: 5 Versuche pro Minute je IP, 3 pro Stunde je E-Mail
+ip_limiter = schutz.RateLimiter(rate=5 / 60, kapazitaet=5)
+email_limiter = schutz.RateLimiter(rate=3 / 3600, kapazitaet=3)
+abweisungen = schutz.Abweisungszaehler()
+MAX_NAMEN_LAENGE = 100
+MAX_EMAIL_LAENGE = 254
+# Das Formular ist klein; größere Anfragen werden vor dem Parsen mit 413 abgewiesen
+SUBMIT_MAX_BYTES = 16 * 1024
+SUBMIT_MAX_FELD_BYTES = 4 * 1024
+
+def ist_ganzzahl(wert):
+    """JSON-Zahl ohne Nachkommastellen; true/false sind in Python auch int"""
+    return isinstance(wert, int) and not isinstance(wert, bool)
+
+def aktueller_mandant():
+    """Mandant der laufenden Anfrage (None im Einzelbetrieb)"""
+    if not flask.has_request_context():
+        return None
+    return flask.request.environ.get(mandanten.ENVIRON_SCHLUESSEL)
 
-def get_db_connection():
-    """Hilfsfunktion für Datenbankverbindungen"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+def get_speicher(mandant=None):
+    """Datenzugriff für den Mandanten der Anfrage (SQLite oder PostgreSQL, siehe speicher.py)"""
+    return speicher.erstellen(mandant or aktueller_mandant())
+
+def eingerichtete_mandanten():
+    """Alle Mandanten, im Einzelbetrieb [None]"""
+    return speicher.alle_mandanten() if mandanten.MANDANTEN_MODUS else [None]
+
+#===========================================================
+#                       Start-Phase
+#===========================================================
+JAHRGANG_CACHE_SEKUNDEN = 60
+START_WARTEZEIT_SEKUNDEN = 0.5   # erste Pause nach einem Fehlschlag, danach verdoppelt
+START_MAX_WARTEZEIT_SEKUNDEN = 30
+
+bereit = threading.Event()
+startzeit_sekunden = None
+# Mandant -> Fehlertext (nur fürs Protokoll). Diese Mandanten antworten mit
+# 503 und werden im Hintergrund erneut vorbereitet, die übrigen laufen weiter.
+fehlerhafte_mandanten = {}
+vorbereitete_mandanten = set()
+_jahrgang_cache = {}  # Mandant -> (Zeitpunkt, aktive Jahrgänge)
+
+def aktive_jahrgaenge(mandant=None):
+    """Aktive Jahrgänge für das Formular, kurz zwischengespeichert"""
+    mandant = mandant or aktueller_mandant()
+    eintrag = _jahrgang_cache.get(mandant)
+    if eintrag and time.monotonic() - eintrag[0] < JAHRGANG_CACHE_SEKUNDEN:
+        return eintrag[1]
+    
+    jahrgaenge = get_speicher(mandant).aktive_jahrgaenge()
+    _jahrgang_cache[mandant] = (time.monotonic(), jahrgaenge)
+    return jahrgaenge
+
+def jahrgang_cache_leeren(mandant=None):
+    """Nach Änderungen an Jahrgängen aufrufen"""
+    _jahrgang_cache.pop(mandant or aktueller_mandant(), None)
+
+def datenbank_vorbereiten(mandant=None):
+    """Schema prüfen/aktualisieren, Daten und Jahrgangsliste vorwärmen"""
+    name = mandant or 'Standard'
+    db = get_speicher(mandant)
+    alte_version, neue_version = db.schema_aktualisieren()
+    if alte_version != neue_version:
+        print(f'{name}: Schema von Version {alte_version} auf {neue_version} aktualisiert')
+    if not db.admin_vorhanden():
+        print(f'{name}: Kein Admin-Benutzer vorhanden, bitte install.py ausführen')
+    # Abgleich nach abgebrochenem (De-)Aktivieren: Archiv und aktive Tabelle
+    # müssen zum Status des Jahrgangs passen
+    archiviert = db.inaktive_archivieren()
+    if archiviert:
+        print(f'{name}: {archiviert} Einträge inaktiver Jahrgänge archiviert')
+    wiederhergestellt = db.aktive_wiederherstellen()
+    if wiederhergestellt:
+        print(f'{name}: {wiederhergestellt} Einträge aktiver Jahrgänge aus dem Archiv zurückgeholt')
+    db.vorwaermen()
+    
+    jahrgang_cache_leeren(mandant)
+    aktive_jahrgaenge(mandant)
+
+def mandanten_vorbereiten():
+    """Alle noch nicht vorbereiteten Mandanten einzeln vorbereiten; Fehler bleiben beim Mandanten"""
+    mandanten_liste = eingerichtete_mandanten()
+    # Inzwischen entfernte Mandanten nicht weiter versuchen
+    for mandant in set(fehlerhafte_mandanten) - set(mandanten_liste):
+        fehlerhafte_mandanten.pop(mandant, None)
+    for mandant in mandanten_liste:
+        if mandant in vorbereitete_mandanten:
+            continue
+        try:
+            datenbank_vorbereiten(mandant)
+        except Exception as e:
+            # z. B. gesperrte Datenbank, weil ein anderer Prozess gerade migriert,
+            # oder eine beschädigte Datei
+            fehlerhafte_mandanten[mandant] = str(e)
+            print(f'{mandant or "Standard"}: Vorbereitung fehlgeschlagen: {e}')
+        else:
+            fehlerhafte_mandanten.pop(mandant, None)
+            vorbereitete_mandanten.add(mandant)
+
+def start_phase():
+    """
+    Bereitet alle Datenbanken und Templates vor und setzt dann 'bereit'.
+
+    'bereit' wird gesetzt, sobald jeder Mandant einmal versucht wurde.
+    Fehlgeschlagene Mandanten werden mit wachsender Pause erneut versucht,
+    bis alle vorbereitet sind.
+    """
+    global startzeit_sekunden
+    start = time.perf_counter()
+    wartezeit = START_WARTEZEIT_SEKUNDEN
+    while True:
+        try:
+            mandanten_vorbereiten()
+            if not bereit.is_set():
+                for template_name in app.jinja_env.list_templates():
+                    app.jinja_env.get_template(template_name)
+                startzeit_sekunden = time.perf_counter() - start
+                bereit.set()
+                print(f'Start-Phase abgeschlossen in {startzeit_sekunden * 1000:.0f} ms')
+            if not fehlerhafte_mandanten:
+                return
+            grund = f'{len(fehlerhafte_mandanten)} Mandant(en) nicht bereit'
+        except Exception as e:
+            # z. B. Mandantenliste nicht lesbar, weil PostgreSQL nicht erreichbar ist
+            grund = f'Start-Phase fehlgeschlagen: {e}'
+        print(f'{grund} (neuer Versuch in {wartezeit:g} s)')
+        time.sleep(wartezeit)
+        wartezeit = min(wartezeit * 2, START_MAX_WARTEZEIT_SEKUNDEN)
+
+#===========================================================
+#                       Aufbewahrung
+#===========================================================
+aufbewahrung_letzte_laeufe = {}  # Mandant -> (Zeitpunkt, Ergebnis)
+_aufbewahrung_lock = threading.Lock()
+
+def aufbewahrung_ausfuehren(mandant=None):
+    """Aufbewahrungsregeln für einen Mandanten anwenden und das Ergebnis merken"""
+    name = mandant or 'Standard'
+    # Zeitplan und Admin-Seite sollen nicht gleichzeitig laufen
+    with _aufbewahrung_lock:
+        ergebnis = aufbewahrung.ausfuehren(get_speicher(mandant))
+    aufbewahrung_letzte_laeufe[mandant] = (datetime.datetime.now(), ergebnis)
+    for zeile in ergebnis:
+        if zeile['aktiv'] or zeile['archiviert']:
+            print(f"{name}: Aufbewahrung {zeile['regel']}: "
+                  f"{zeile['aktiv']} aktive und {zeile['archiviert']} archivierte Einträge")
+    return ergebnis
+
+def aufbewahrung_zeitplan():
+    """Hintergrund-Thread: Regeln regelmäßig auf alle Mandanten anwenden"""
+    bereit.wait()
+    while True:
+        try:
+            for mandant in eingerichtete_mandanten():
+                if mandant in fehlerhafte_mandanten:
+                    continue
+                try:
+                    aufbewahrung_ausfuehren(mandant)
+                except Exception as e:
+                    print(f'{mandant or "Standard"}: Aufbewahrung fehlgeschlagen: {e}')
+        except Exception as e:
+            print(f'Aufbewahrung: Mandanten nicht lesbar: {e}')
+        time.sleep(aufbewahrung.AUFBEWAHRUNG_INTERVALL_STUNDEN * 3600)
+
+@app.before_request
+def bereitschaft_pruefen():
+    """Bis zum Ende der Start-Phase nur Health-Checks beantworten, danach nur fehlerhafte Mandanten sperren"""
+    if flask.request.endpoint in ('healthz', 'readyz', 'static'):
+        return None
+    if not bereit.is_set():
+        return 'Dienst startet noch.', 503, {'Retry-After': '1'}
+    if aktueller_mandant() in fehlerhafte_mandanten:
+        return 'Diese Schule ist vorübergehend nicht erreichbar.', 503, {'Retry-After': '30'}
+
+@app.before_request
+def mandant_pruefen():
+    """Admin-Sitzung gilt nur für den Mandanten, an dem angemeldet wurde"""
+    if 'admin_logged_in' in flask.session and flask.session.get('mandant') != aktueller_mandant():
+        flask.session.pop('admin_logged_in', None)
+        flask.session.pop('admin_id', None)
+        flask.session.pop('mandant', None)
 
 #===========================================================
 #                     Webseiten Routen
@@ -22,10 +214,23 @@ def get_db_connection():
 @app.route('/')
 def home():
     """Hauptseite mit Formular für Schülerdaten"""
-    conn = get_db_connection()
-    jahrgaenge = conn.execute('SELECT * FROM abitur_jahrgaenge WHERE aktiv = 1 ORDER BY jahrgang DESC').fetchall()
-    conn.close()
-    return flask.render_template('index.html', jahrgaenge=jahrgaenge)
+    jahrgaenge = aktive_jahrgaenge()
+    formular_token = schutz.formular_token_erstellen(app.secret_key, aktueller_mandant() or '')
+    return flask.render_template('index.html', jahrgaenge=jahrgaenge, formular_token=formular_token)
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: Prozess läuft"""
+    return 'ok'
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: Start-Phase abgeschlossen und mindestens ein Mandant vorbereitet"""
+    # Öffentlich erreichbar: keine Fehlertexte (DSN, Pfade), die stehen im Protokoll
+    if not bereit.is_set() or (fehlerhafte_mandanten and not vorbereitete_mandanten):
+        return flask.jsonify(bereit=False, fehlerhafte_mandanten=len(fehlerhafte_mandanten)), 503
+    return flask.jsonify(bereit=True, startzeit_ms=round(startzeit_sekunden * 1000),
+                         fehlerhafte_mandanten=len(fehlerhafte_mandanten))
 
 @app.route('/datenschutz')
 def datenschutz():
@@ -38,15 +243,7 @@ def admin_jahrgaenge():
     if 'admin_logged_in' not in flask.session:
         return flask.redirect(flask.url_for('admin_login'))
     
-    conn = get_db_connection()
-    jahrgaenge = conn.execute('''
-        SELECT a.*, COUNT(s.id) as schueler_anzahl 
-        FROM abitur_jahrgaenge a
-        LEFT JOIN schueler_daten s ON a.id = s.jahrgang_id
-        GROUP BY a.id
-        ORDER BY a.jahrgang DESC
-    ''').fetchall()
-    conn.close()
+    jahrgaenge = get_speicher().jahrgaenge_uebersicht()
     
     return flask.render_template('admin_jahrgaenge.html', jahrgaenge=jahrgaenge)
 
@@ -56,27 +253,24 @@ def admin_dashboard():
     if 'admin_logged_in' not in flask.session:
         return flask.redirect(flask.url_for('admin_login'))
     
-    conn = get_db_connection()
+    suche = flask.request.args.get('suche', '').strip()
+    db = get_speicher()
     
-    # Alle Schülerdaten mit Jahrgang abrufen
-    schueler = conn.execute('''
-        SELECT s.*, a.jahrgang 
-        FROM schueler_daten s
-        JOIN abitur_jahrgaenge a ON s.jahrgang_id = a.id
-        ORDER BY s.erstellt_am DESC
-    ''').fetchall()
+    if suche:
+        # Suche läuft über aktive und archivierte Einträge
+        schueler = db.schueler_suchen(suche)
+    else:
+        # Alle Schülerdaten mit Jahrgang abrufen
+        schueler = db.schueler_liste()
     
-    # Statistiken
-    stats = conn.execute('''
-        SELECT 
-            COUNT(*) as total_schueler,
-            COUNT(DISTINCT jahrgang_id) as aktive_jahrgaenge
-        FROM schueler_daten
-    ''').fetchone()
+    # Ziele für "Verschieben"
+    alle_jahrgaenge = db.alle_jahrgaenge()
     
-    conn.close()
+    # Statistiken
+    stats = db.statistik()
     
-    return flask.render_template('admin_dashboard.html', schueler=schueler, stats=stats)
+    return flask.render_template('admin_dashboard.html', schueler=schueler, stats=stats, suche=suche,
+                                 alle_jahrgaenge=alle_jahrgaenge)
 
 @app.route('/admin')
 def admin_login():
@@ -93,29 +287,66 @@ def admin_login():
 @app.route('/submit', methods=['POST'])
 def submit_data():
     """Verarbeite eingereichte Schülerdaten"""
+    mandant = aktueller_mandant() or ''
+    flask.request.max_content_length = SUBMIT_MAX_BYTES
+    flask.request.max_form_memory_size = SUBMIT_MAX_FELD_BYTES
+    
+    # Alle Prüfungen bis zum INSERT kommen ohne Datenbankzugriff aus
+    if not ip_limiter.erlauben(f'{mandant}:{flask.request.remote_addr}'):
+        abweisungen.erhoehen('ip_limit')
+        flask.flash('Zu viele Anfragen. Bitte versuchen Sie es später erneut.', 'error')
+        return flask.redirect(flask.url_for('home'))
+    
+    if flask.request.form.get(schutz.HONEYPOT_FELD):
+        # Bots bekommen keinen Hinweis, dass sie erkannt wurden
+        abweisungen.erhoehen('honeypot')
+        flask.flash('Daten erfolgreich gespeichert!', 'success')
+        return flask.redirect(flask.url_for('home'))
+    
+    token = schutz.formular_token_pruefen(app.secret_key, flask.request.form.get(schutz.TOKEN_FELD), mandant)
+    if token == schutz.TOKEN_ZU_FRUEH:
+        abweisungen.erhoehen('zu_schnell')
+        flask.flash('Das Formular wurde zu schnell abgesendet. Bitte warten Sie einen Moment und versuchen Sie es erneut.', 'error')
+        return flask.redirect(flask.url_for('home'))
+    if token != schutz.TOKEN_OK:
+        abweisungen.erhoehen('token')
+        flask.flash('Das Formular ist abgelaufen. Bitte laden Sie die Seite neu und versuchen Sie es erneut.', 'error')
+        return flask.redirect(flask.url_for('home'))
+    
     jahrgang_id = flask.request.form.get('jahrgang_id')
-    vorname = flask.request.form.get('vorname')
-    nachname = flask.request.form.get('nachname')
-    email = flask.request.form.get('email')
+    vorname = flask.request.form.get('vorname', '').strip()
+    nachname = flask.request.form.get('nachname', '').strip()
+    email = flask.request.form.get('email', '').strip()
     datenschutz_einwilligung = flask.request.form.get('datenschutz_einwilligung')
     
     if not all([jahrgang_id, vorname, nachname, email]):
+        abweisungen.erhoehen('unvollstaendig')
         flask.flash('Alle Felder müssen ausgefüllt werden!', 'error')
         return flask.redirect(flask.url_for('home'))
     
+    if (not jahrgang_id.isdecimal() or '@' not in email
+            or len(vorname) > MAX_NAMEN_LAENGE or len(nachname) > MAX_NAMEN_LAENGE
+            or len(email) > MAX_EMAIL_LAENGE):
+        abweisungen.erhoehen('ungueltig')
+        flask.flash('Bitte überprüfen Sie Ihre Eingaben!', 'error')
+        return flask.redirect(flask.url_for('home'))
+    
     if not datenschutz_einwilligung:
+        abweisungen.erhoehen('datenschutz')
         flask.flash('Die Datenschutzerklärung muss akzeptiert werden!', 'error')
         return flask.redirect(flask.url_for('home'))
     
+    if not email_limiter.erlauben(f'{mandant}:{schutz.email_normalisieren(email)}'):
+        abweisungen.erhoehen('email_limit')
+        flask.flash('Für diese E-Mail-Adresse wurden zu viele Einträge gesendet. Bitte versuchen Sie es später erneut.', 'error')
+        return flask.redirect(flask.url_for('home'))
+    
     try:
-        conn = get_db_connection()
-        conn.execute('''
-            INSERT INTO schueler_daten (jahrgang_id, vorname, nachname, email, datenschutz_einwilligung)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (jahrgang_id, vorname, nachname, email, True))
-        conn.commit()
-        conn.close()
-        flask.flash('Daten erfolgreich gespeichert!', 'success')
+        if get_speicher().schueler_hinzufuegen(int(jahrgang_id), vorname, nachname, email):
+            flask.flash('Daten erfolgreich gespeichert!', 'success')
+        else:
+            jahrgang_cache_leeren()
+            flask.flash('Dieser Jahrgang nimmt keine Anmeldungen mehr an. Bitte wählen Sie erneut.', 'error')
     except Exception as e:
         flask.flash(f'Fehler beim Speichern: {str(e)}', 'error')
     
@@ -134,14 +365,12 @@ def admin_login_post():
     
     passwort_hash = hashlib.sha256(passwort.encode()).hexdigest()
     
-    conn = get_db_connection()
-    admin = conn.execute('SELECT * FROM admins WHERE benutzername = ? AND passwort_hash = ?',
-                        (benutzername, passwort_hash)).fetchone()
-    conn.close()
+    admin = get_speicher().admin_anmelden(benutzername, passwort_hash)
     
     if admin:
         flask.session['admin_logged_in'] = True
         flask.session['admin_id'] = admin['id']
+        flask.session['mandant'] = aktueller_mandant()
         return flask.redirect(flask.url_for('admin_dashboard'))
     else:
         flask.flash('Ungültige Anmeldedaten!', 'error')
@@ -152,6 +381,7 @@ def admin_logout():
     """Admin-Logout"""
     flask.session.pop('admin_logged_in', None)
     flask.session.pop('admin_id', None)
+    flask.session.pop('mandant', None)
     return flask.redirect(flask.url_for('home'))
 
 
@@ -175,19 +405,16 @@ def admin_add_jahrgang():
             flask.flash('Bitte geben Sie eine gültige Jahreszahl ein!', 'error')
             return flask.redirect(flask.url_for('admin_jahrgaenge'))
         
-        conn = get_db_connection()
-        conn.execute('INSERT INTO abitur_jahrgaenge (jahrgang) VALUES (?)', (jahrgang,))
-        conn.commit()
-        conn.close()
+        get_speicher().jahrgang_hinzufuegen(jahrgang)
+        jahrgang_cache_leeren()
         
         flask.flash(f'Jahrgang {jahrgang} erfolgreich hinzugefügt!', 'success')
     except ValueError:
         flask.flash('Bitte geben Sie eine gültige Jahreszahl ein!', 'error')
+    except speicher.DoppelterEintrag:
+        flask.flash('Dieser Jahrgang existiert bereits!', 'error')
     except Exception as e:
-        if 'UNIQUE constraint failed' in str(e):
-            flask.flash('Dieser Jahrgang existiert bereits!', 'error')
-        else:
-            flask.flash(f'Fehler beim Hinzufügen: {str(e)}', 'error')
+        flask.flash(f'Fehler beim Hinzufügen: {str(e)}', 'error')
     
     return flask.redirect(flask.url_for('admin_jahrgaenge'))
 
@@ -197,18 +424,30 @@ def admin_toggle_jahrgang(jahrgang_id):
     if 'admin_logged_in' not in flask.session:
         return flask.redirect(flask.url_for('admin_login'))
     
-    conn = get_db_connection()
-    jahrgang = conn.execute('SELECT * FROM abitur_jahrgaenge WHERE id = ?', (jahrgang_id,)).fetchone()
+    db = get_speicher()
+    jahrgang = db.jahrgang_finden(jahrgang_id)
     
     if jahrgang:
         new_status = not jahrgang['aktiv']
-        conn.execute('UPDATE abitur_jahrgaenge SET aktiv = ? WHERE id = ?', (new_status, jahrgang_id))
-        conn.commit()
+        db.jahrgang_aktiv_setzen(jahrgang_id, new_status)
+        jahrgang_cache_leeren()
         
         status_text = 'aktiviert' if new_status else 'deaktiviert'
         flask.flash(f'Jahrgang {jahrgang["jahrgang"]} wurde {status_text}!', 'success')
+        
+        # Schülerdaten inaktiver Jahrgänge liegen im Archiv
+        try:
+            if new_status:
+                anzahl = db.jahrgang_wiederherstellen(jahrgang_id)
+                if anzahl:
+                    flask.flash(f'{anzahl} Einträge aus dem Archiv wiederhergestellt.', 'success')
+            else:
+                anzahl = db.jahrgang_archivieren(jahrgang_id)
+                if anzahl:
+                    flask.flash(f'{anzahl} Einträge ins Archiv verschoben.', 'success')
+        except Exception as e:
+            flask.flash(f'Fehler beim Archivieren: {str(e)} (wird beim nächsten Start abgeglichen)', 'error')
     
-    conn.close()
     return flask.redirect(flask.url_for('admin_jahrgaenge'))
 
 @app.route('/admin/jahrgang/delete/<int:jahrgang_id>')
@@ -217,107 +456,97 @@ def admin_delete_jahrgang(jahrgang_id):
     if 'admin_logged_in' not in flask.session:
         return flask.redirect(flask.url_for('admin_login'))
     
-    conn = get_db_connection()
+    db = get_speicher()
     
     try:
         # Jahrgang-Info für Bestätigung abrufen
-        jahrgang = conn.execute('SELECT jahrgang FROM abitur_jahrgaenge WHERE id = ?', (jahrgang_id,)).fetchone()
+        jahrgang = db.jahrgang_finden(jahrgang_id)
         
         if not jahrgang:
             flask.flash('Jahrgang nicht gefunden!', 'error')
             return flask.redirect(flask.url_for('admin_jahrgaenge'))
         
-        # Anzahl betroffener Schüler ermitteln
-        schueler_count = conn.execute('SELECT COUNT(*) as count FROM schueler_daten WHERE jahrgang_id = ?', 
-                                      (jahrgang_id,)).fetchone()
-        
-        # Alle Schüler des Jahrgangs löschen
-        conn.execute('DELETE FROM schueler_daten WHERE jahrgang_id = ?', (jahrgang_id,))
-        
-        # Jahrgang löschen
-        conn.execute('DELETE FROM abitur_jahrgaenge WHERE id = ?', (jahrgang_id,))
-        
-        conn.commit()
+        # Jahrgang mit allen (auch archivierten) Schülern löschen
+        schueler_count = db.jahrgang_loeschen(jahrgang_id)
+        jahrgang_cache_leeren()
         
-        if schueler_count['count'] > 0:
-            flask.flash(f'Jahrgang {jahrgang["jahrgang"]} und {schueler_count["count"]} zugehörige Schüler erfolgreich gelöscht!', 'success')
+        if schueler_count > 0:
+            flask.flash(f'Jahrgang {jahrgang["jahrgang"]} und {schueler_count} zugehörige Schüler erfolgreich gelöscht!', 'success')
         else:
             flask.flash(f'Jahrgang {jahrgang["jahrgang"]} erfolgreich gelöscht!', 'success')
             
     except Exception as e:
-        conn.rollback()
         flask.flash(f'Fehler beim Löschen: {str(e)}', 'error')
-    finally:
-        conn.close()
     
     return flask.redirect(flask.url_for('admin_jahrgaenge'))
 
+CSV_BLOCK_ZEILEN = 500
+
+def csv_antwort(zeilen, dateiname):
+    """CSV-Datei blockweise streamen, statt den ganzen Export im Speicher zu bauen"""
+    def erzeugen():
+        output = io.StringIO()
+        writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_MINIMAL)
+        
+        # Header schreiben
+        writer.writerow([
+            'Jahrgang',
+            'Vorname', 
+            'Nachname',
+            'E-Mail',
+            'Datenschutz erteilt',
+            'Datenschutz Datum',
+            'Widerrufen am',
+            'Registriert am'
+        ])
+        
+        # Datenzeilen schreiben
+        for nummer, schueler_eintrag in enumerate(zeilen, 1):
+            writer.writerow([
+                schueler_eintrag['jahrgang'],
+                schueler_eintrag['vorname'],
+                schueler_eintrag['nachname'],
+                schueler_eintrag['email'],
+                'Ja' if schueler_eintrag['datenschutz_einwilligung'] else 'Nein',
+                schueler_eintrag['datenschutz_datum'],
+                schueler_eintrag['widerrufen_am'] or '',
+                schueler_eintrag['erstellt_am']
+            ])
+            if nummer % CSV_BLOCK_ZEILEN == 0:
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
+        
+        yield output.getvalue()
+        output.close()
+    
+    response = flask.Response(erzeugen(), mimetype='text/csv')
+    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+    response.headers['Content-Disposition'] = f'attachment; filename="{dateiname}"'
+    return response
+
 @app.route('/admin/export/csv')
 def admin_export_csv():
     """CSV-Export aller Schülerdaten"""
     if 'admin_logged_in' not in flask.session:
         return flask.redirect(flask.url_for('admin_login'))
     
-    conn = get_db_connection()
+    db = get_speicher()
     
     # Alle Schülerdaten mit Jahrgang abrufen
     try:
-        schueler = conn.execute('''
-            SELECT s.jahrgang_id, a.jahrgang, s.vorname, s.nachname, s.email, 
-                   COALESCE(s.datenschutz_einwilligung, 1) as datenschutz_einwilligung, 
-                   COALESCE(s.datenschutz_datum, s.erstellt_am) as datenschutz_datum, 
-                   s.erstellt_am
-            FROM schueler_daten s
-            JOIN abitur_jahrgaenge a ON s.jahrgang_id = a.id
-            ORDER BY a.jahrgang DESC, s.nachname, s.vorname
-        ''').fetchall()
+        anzahl = db.export_anzahl()
     except Exception as e:
         flask.flash(f'Fehler beim Abrufen der Schülerdaten: {str(e)}', 'error')
         return flask.redirect(flask.url_for('admin_dashboard'))
-
-    conn.close()
-    
-    # CSV-Datei erstellen
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_MINIMAL)
-    
-    # Header schreiben
-    writer.writerow([
-        'Jahrgang',
-        'Vorname', 
-        'Nachname',
-        'E-Mail',
-        'Datenschutz erteilt',
-        'Datenschutz Datum',
-        'Registriert am'
-    ])
-    
-    # Datenzeilen schreiben
-    for schueler_eintrag in schueler:
-        writer.writerow([
-            schueler_eintrag['jahrgang'],
-            schueler_eintrag['vorname'],
-            schueler_eintrag['nachname'],
-            schueler_eintrag['email'],
-            'Ja' if schueler_eintrag['datenschutz_einwilligung'] else 'Nein',
-            schueler_eintrag['datenschutz_datum'],
-            schueler_eintrag['erstellt_am']
-        ])
-    
-    csv_data = output.getvalue()
-    output.close()
     
     # Dateiname mit aktuellem Datum
     heute = datetime.datetime.now().strftime('%Y-%m-%d')
     dateiname = f'schueler_export_{heute}.csv'
     
-    response = flask.make_response(csv_data)
-    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = f'attachment; filename="{dateiname}"'
-    
-    flask.flash(f'CSV-Export erfolgreich erstellt: {len(schueler)} Schüler exportiert', 'success')
+    flask.flash(f'CSV-Export erfolgreich erstellt: {anzahl} Schüler exportiert', 'success')
     
-    return response
+    return csv_antwort(db.export_zeilen(), dateiname)
 
 @app.route('/admin/export/csv/<int:jahrgang_id>')
 def admin_export_csv_jahrgang(jahrgang_id):
@@ -325,10 +554,10 @@ def admin_export_csv_jahrgang(jahrgang_id):
     if 'admin_logged_in' not in flask.session:
         return flask.redirect(flask.url_for('admin_login'))
     
-    conn = get_db_connection()
+    db = get_speicher()
     
     # Jahrgang-Info abrufen
-    jahrgang_info = conn.execute('SELECT jahrgang FROM abitur_jahrgaenge WHERE id = ?', (jahrgang_id,)).fetchone()
+    jahrgang_info = db.jahrgang_finden(jahrgang_id)
     
     if not jahrgang_info:
         flask.flash('Jahrgang nicht gefunden!', 'error')
@@ -336,65 +565,20 @@ def admin_export_csv_jahrgang(jahrgang_id):
     
     # Schülerdaten für diesen Jahrgang abrufen
     try:
-        schueler = conn.execute('''
-            SELECT s.jahrgang_id, a.jahrgang, s.vorname, s.nachname, s.email, 
-                   COALESCE(s.datenschutz_einwilligung, 1) as datenschutz_einwilligung, 
-                   COALESCE(s.datenschutz_datum, s.erstellt_am) as datenschutz_datum, 
-                   s.erstellt_am
-            FROM schueler_daten s
-            JOIN abitur_jahrgaenge a ON s.jahrgang_id = a.id
-            WHERE s.jahrgang_id = ?
-            ORDER BY s.nachname, s.vorname
-        ''', (jahrgang_id,)).fetchall()
+        anzahl = db.export_anzahl(jahrgang_id)
     except Exception as e:
         flask.flash(f'Fehler beim Abrufen der Schülerdaten: {str(e)}', 'error')
         return flask.redirect(flask.url_for('admin_dashboard'))
     
-    conn.close()
-    
-    if not schueler:
+    if not anzahl:
         flask.flash(f'Keine Schüler im Jahrgang {jahrgang_info["jahrgang"]} gefunden!', 'error')
         return flask.redirect(flask.url_for('admin_dashboard'))
     
-    # CSV-Datei erstellen
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_MINIMAL)
-    
-    # Header schreiben
-    writer.writerow([
-        'Jahrgang',
-        'Vorname', 
-        'Nachname',
-        'E-Mail',
-        'Datenschutz erteilt',
-        'Datenschutz Datum',
-        'Registriert am'
-    ])
-    
-    # Datenzeilen schreiben
-    for schueler_eintrag in schueler:
-        writer.writerow([
-            schueler_eintrag['jahrgang'],
-            schueler_eintrag['vorname'],
-            schueler_eintrag['nachname'],
-            schueler_eintrag['email'],
-            'Ja' if schueler_eintrag['datenschutz_einwilligung'] else 'Nein',
-            schueler_eintrag['datenschutz_datum'],
-            schueler_eintrag['erstellt_am']
-        ])
-    
-    csv_data = output.getvalue()
-    output.close()
-    
     # Dateiname mit Jahrgang und Datum
     heute = datetime.datetime.now().strftime('%Y-%m-%d')
     dateiname = f'schueler_jahrgang_{jahrgang_info["jahrgang"]}_{heute}.csv'
     
-    response = flask.make_response(csv_data)
-    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = f'attachment; filename="{dateiname}"'
-    
-    return response
+    return csv_antwort(db.export_zeilen(jahrgang_id), dateiname)
 
 @app.route('/admin/delete/<int:schueler_id>')
 def admin_delete_schueler(schueler_id):
@@ -402,23 +586,138 @@ def admin_delete_schueler(schueler_id):
     if 'admin_logged_in' not in flask.session:
         return flask.redirect(flask.url_for('admin_login'))
     
-    conn = get_db_connection()
-    conn.execute('DELETE FROM schueler_daten WHERE id = ?', (schueler_id,))
-    conn.commit()
-    conn.close()
+    get_speicher().schueler_loeschen(schueler_id)
     
     flask.flash('Eintrag erfolgreich gelöscht!', 'success')
     return flask.redirect(flask.url_for('admin_dashboard'))
 
+@app.route('/admin/schueler/bulk', methods=['POST'])
+def admin_bulk_schueler():
+    """Sammelaktionen für mehrere Schüler-Einträge (Formular oder JSON)"""
+    if 'admin_logged_in' not in flask.session:
+        if flask.request.is_json:
+            return flask.jsonify(fehler='Nicht angemeldet'), 401
+        return flask.redirect(flask.url_for('admin_login'))
+    
+    if flask.request.is_json:
+        daten = flask.request.get_json(silent=True)
+        if not isinstance(daten, dict):
+            daten = {}
+        aktion = daten.get('aktion')
+        ids = daten.get('ids')
+        ziel_jahrgang_id = daten.get('ziel_jahrgang_id')
+        # Nur echte Zahlen: ein String würde sonst in einzelne Ziffern
+        # zerfallen und true zu id bzw. Jahrgang 1 werden
+        if not isinstance(ids, list) or not all(ist_ganzzahl(i) for i in ids):
+            return flask.jsonify(fehler='ids muss eine Liste von Zahlen sein'), 400
+        if aktion == 'verschieben' and not ist_ganzzahl(ziel_jahrgang_id):
+            return flask.jsonify(fehler='ziel_jahrgang_id muss eine Zahl sein'), 400
+    else:
+        aktion = flask.request.form.get('aktion')
+        ids = flask.request.form.getlist('schueler_ids')
+        ziel_jahrgang_id = flask.request.form.get('ziel_jahrgang_id')
+    
+    def antwort(zusammenfassung, status=200):
+        if flask.request.is_json:
+            return flask.jsonify(zusammenfassung), status
+        if 'fehler' in zusammenfassung:
+            flask.flash(zusammenfassung['fehler'], 'error')
+        else:
+            meldung = f'{zusammenfassung["betroffen"]} von {zusammenfassung["angefordert"]} Einträgen bearbeitet'
+            if zusammenfassung['unveraendert']:
+                meldung += f', {zusammenfassung["unveraendert"]} unverändert'
+            if zusammenfassung['nicht_gefunden']:
+                meldung += f', {zusammenfassung["nicht_gefunden"]} nicht gefunden'
+            flask.flash(meldung + '.', 'success')
+        return flask.redirect(flask.url_for('admin_dashboard'))
+    
+    try:
+        ids = sorted({int(i) for i in ids})
+        if aktion == 'verschieben':
+            ziel_jahrgang_id = int(ziel_jahrgang_id)
+    except (TypeError, ValueError):
+        return antwort({'fehler': 'Ungültige Auswahl!'}, 400)
+    
+    if aktion not in speicher.BULK_AKTIONEN:
+        return antwort({'fehler': 'Unbekannte Aktion!'}, 400)
+    if not ids:
+        return antwort({'fehler': 'Keine Einträge ausgewählt!'}, 400)
+    
+    try:
+        ergebnis = get_speicher().bulk(aktion, ids, ziel_jahrgang_id)
+    except Exception as e:
+        return antwort({'fehler': f'Fehler bei der Sammelaktion: {str(e)}'}, 400)
+    
+    return antwort(dict(ergebnis, aktion=aktion, angefordert=len(ids)))
+
+@app.route('/admin/schutz')
+def admin_schutz():
+    """Zähler der abgewiesenen Formular-Anfragen (JSON)"""
+    if 'admin_logged_in' not in flask.session:
+        return flask.redirect(flask.url_for('admin_login'))
+    
+    return flask.jsonify(
+        abweisungen=abweisungen.als_dict(),
+        ip_schluessel=len(ip_limiter),
+        email_schluessel=len(email_limiter)
+    )
+
+@app.route('/admin/aufbewahrung')
+def admin_aufbewahrung():
+    """Aufbewahrungsregeln mit Probelauf und Protokoll"""
+    if 'admin_logged_in' not in flask.session:
+        return flask.redirect(flask.url_for('admin_login'))
+    
+    db = get_speicher()
+    probelauf = aufbewahrung.ausfuehren(db, probelauf=True)
+    protokoll = db.aufbewahrung_protokoll()
+    letzter_lauf = aufbewahrung_letzte_laeufe.get(aktueller_mandant())
+    
+    return flask.render_template('admin_aufbewahrung.html', probelauf=probelauf, protokoll=protokoll,
+                                 letzter_lauf=letzter_lauf,
+                                 intervall=aufbewahrung.AUFBEWAHRUNG_INTERVALL_STUNDEN)
+
+@app.route('/admin/aufbewahrung/probelauf')
+def admin_aufbewahrung_probelauf():
+    """Probelauf der Aufbewahrungsregeln (JSON)"""
+    if 'admin_logged_in' not in flask.session:
+        return flask.redirect(flask.url_for('admin_login'))
+    
+    return flask.jsonify(regeln=aufbewahrung.ausfuehren(get_speicher(), probelauf=True))
+
+@app.route('/admin/aufbewahrung/ausfuehren', methods=['POST'])
+def admin_aufbewahrung_ausfuehren():
+    """Aufbewahrungsregeln sofort anwenden"""
+    if 'admin_logged_in' not in flask.session:
+        return flask.redirect(flask.url_for('admin_login'))
+    
+    if not aufbewahrung.REGELN:
+        flask.flash('Keine Aufbewahrungsregeln eingestellt (AUFBEWAHRUNG_REGELN)!', 'error')
+        return flask.redirect(flask.url_for('admin_aufbewahrung'))
+    
+    try:
+        ergebnis = aufbewahrung_ausfuehren(aktueller_mandant())
+        anzahl = sum(zeile['aktiv'] + zeile['archiviert'] for zeile in ergebnis)
+        flask.flash(f'Aufbewahrungsregeln angewendet: {anzahl} Einträge bearbeitet.', 'success')
+    except Exception as e:
+        flask.flash(f'Fehler bei der Aufbewahrung: {str(e)}', 'error')
+    
+    return flask.redirect(flask.url_for('admin_aufbewahrung'))
+
+@app.errorhandler(413)
+def anfrage_zu_gross(e):
+    """Zu große Anfragen abweisen; beim öffentlichen Formular als Abweisung zählen"""
+    if flask.request.endpoint == 'submit_data':
+        abweisungen.erhoehen('zu_gross')
+    return 'Anfrage zu groß.', 413
+
 @app.route('/admin/benutzer')
 def admin_benutzer():
     """Benutzerverwaltung"""
     if 'admin_logged_in' not in flask.session:
         return flask.redirect(flask.url_for('admin_login'))
     
-    conn = get_db_connection()
-    benutzer = conn.execute('SELECT id, benutzername FROM admins ORDER BY benutzername').fetchall()
-    conn.close()
+    benutzer = get_speicher().admins()
     
     return flask.render_template('admin_benutzer.html', benutzer=benutzer)
 
@@ -452,14 +751,10 @@ def admin_add_benutzer():
     try:
         passwort_hash = hashlib.sha256(passwort.encode()).hexdigest()
         
-        conn = get_db_connection()
-        conn.execute('INSERT INTO admins (benutzername, passwort_hash) VALUES (?, ?)', 
-                     (benutzername, passwort_hash))
-        conn.commit()
-        conn.close()
+        get_speicher().admin_hinzufuegen(benutzername, passwort_hash)
         
         flask.flash(f'Benutzer "{benutzername}" erfolgreich erstellt!', 'success')
-    except sqlite3.IntegrityError:
+    except speicher.DoppelterEintrag:
         flask.flash('Benutzername bereits vergeben!', 'error')
     except Exception as e:
         flask.flash(f'Fehler beim Erstellen des Benutzers: {str(e)}', 'error')
@@ -493,24 +788,15 @@ def admin_change_password():
         altes_passwort_hash = hashlib.sha256(altes_passwort.encode()).hexdigest()
         neues_passwort_hash = hashlib.sha256(neues_passwort.encode()).hexdigest()
         
-        conn = get_db_connection()
+        # Altes Passwort prüfen und neues setzen
+        benutzername = get_speicher().admin_passwort_aendern(int(benutzer_id), altes_passwort_hash,
+                                                             neues_passwort_hash)
         
-        # Prüfen ob altes Passwort korrekt ist
-        benutzer = conn.execute('SELECT benutzername FROM admins WHERE id = ? AND passwort_hash = ?',
-                               (benutzer_id, altes_passwort_hash)).fetchone()
-        
-        if not benutzer:
+        if not benutzername:
             flask.flash('Altes Passwort ist falsch!', 'error')
-            conn.close()
             return flask.redirect(flask.url_for('admin_benutzer'))
         
-        # Neues Passwort setzen
-        conn.execute('UPDATE admins SET passwort_hash = ? WHERE id = ?',
-                     (neues_passwort_hash, benutzer_id))
-        conn.commit()
-        conn.close()
-        
-        flask.flash(f'Passwort für "{benutzer["benutzername"]}" erfolgreich geändert!', 'success')
+        flask.flash(f'Passwort für "{benutzername}" erfolgreich geändert!', 'success')
     except Exception as e:
         flask.flash(f'Fehler beim Ändern des Passworts: {str(e)}', 'error')
     
@@ -523,37 +809,42 @@ def admin_delete_benutzer(benutzer_id):
         return flask.redirect(flask.url_for('admin_login'))
     
     # Prüfen ob es der einzige Admin ist
-    conn = get_db_connection()
-    admin_count = conn.execute('SELECT COUNT(*) as count FROM admins').fetchone()
+    db = get_speicher()
     
-    if admin_count['count'] <= 1:
+    if db.admin_anzahl() <= 1:
         flask.flash('Der letzte Admin-Benutzer kann nicht gelöscht werden!', 'error')
-        conn.close()
         return flask.redirect(flask.url_for('admin_benutzer'))
     
     # Prüfen ob es der aktuell eingeloggte Benutzer ist
     if int(benutzer_id) == flask.session.get('admin_id'):
         flask.flash('Sie können sich nicht selbst löschen!', 'error')
-        conn.close()
         return flask.redirect(flask.url_for('admin_benutzer'))
     
     try:
-        benutzer = conn.execute('SELECT benutzername FROM admins WHERE id = ?', (benutzer_id,)).fetchone()
+        benutzer = db.admin_finden(benutzer_id)
         
         if benutzer:
-            conn.execute('DELETE FROM admins WHERE id = ?', (benutzer_id,))
-            conn.commit()
+            db.admin_loeschen(benutzer_id)
             flask.flash(f'Benutzer "{benutzer["benutzername"]}" erfolgreich gelöscht!', 'success')
         else:
             flask.flash('Benutzer nicht gefunden!', 'error')
     except Exception as e:
         flask.flash(f'Fehler beim Löschen des Benutzers: {str(e)}', 'error')
-    finally:
-        conn.close()
     
     return flask.redirect(flask.url_for('admin_benutzer'))
 
 
+def hintergrund_starten():
+    """Start-Phase (damit /healthz sofort antwortet) und Aufbewahrungs-Zeitplan als Threads starten"""
+    threading.Thread(target=start_phase, name='start-phase', daemon=True).start()
+    if aufbewahrung.REGELN and aufbewahrung.AUFBEWAHRUNG_INTERVALL_STUNDEN > 0:
+        threading.Thread(target=aufbewahrung_zeitplan, name='aufbewahrung', daemon=True).start()
+
+# Der Reloader von app.run(debug=True) führt diese Datei auch im überwachenden
+# Elternprozess aus; Migrationen und Aufbewahrung laufen nur im Serverprozess
+# (WERKZEUG_RUN_MAIN) bzw. beim Import durch einen WSGI-Server
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    hintergrund_starten()
 
 if __name__ == '__main__':
     app.run(port=80, debug=True, host='0.0.0.0')
\ No newline at end of file
@@ -0,0 +1,198 @@
+"""
+Mandantenfähigkeit: Ein Prozess bedient mehrere Schulen.
+
+Jede Schule (Mandant) hat eine eigene SQLite-Datei unter MANDANTEN_VERZEICHNIS.
+Der Mandant wird entweder aus dem Host (schule-a.example.de) oder aus dem
+ersten Pfadsegment (/schule-a/...) bestimmt. Verbindungen werden pro
+Datenbankdatei gepoolt, erst bei Bedarf geöffnet und bei zu vielen offenen
+Mandanten nach LRU-Prinzip wieder geschlossen.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+
+MANDANTEN_VERZEICHNIS = os.environ.get('MANDANTEN_VERZEICHNIS', 'mandanten')
+# 'host', 'pfad' oder leer (Einzelbetrieb mit DATABASE)
+MANDANTEN_MODUS = os.environ.get('MANDANTEN_MODUS', '').strip().lower()
+MAX_OFFENE_MANDANTEN = int(os.environ.get('MAX_OFFENE_MANDANTEN', '32'))
+MAX_VERBINDUNGEN_PRO_MANDANT = int(os.environ.get('MAX_VERBINDUNGEN_PRO_MANDANT', '4'))
+
+MANDANT_MUSTER = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+ENVIRON_SCHLUESSEL = 'ehemalige.mandant'
+# Pfade, die ohne Mandant erreichbar sind (Health-Checks des Prozesses)
+PFADE_OHNE_MANDANT = ('/healthz', '/readyz')
+
+
+def gueltiger_mandant(name):
+    """Prüft, ob ein Mandantenname erlaubt ist (verhindert Pfad-Tricks)"""
+    return bool(name) and MANDANT_MUSTER.match(name) is not None
+
+
+def mandant_datenbank(name):
+    """Pfad der Datenbankdatei eines Mandanten"""
+    if not gueltiger_mandant(name):
+        raise ValueError(f'Ungültiger Mandantenname: {name!r}')
+    return os.path.join(MANDANTEN_VERZEICHNIS, f'{name}.db')
+
+
+def mandant_existiert(name):
+    """Nur bereits eingerichtete Mandanten (install.py --mandant) sind erreichbar"""
+    return gueltiger_mandant(name) and os.path.isfile(mandant_datenbank(name))
+
+
+def alle_mandanten():
+    """Liste aller eingerichteten Mandanten"""
+    if not os.path.isdir(MANDANTEN_VERZEICHNIS):
+        return []
+    namen = []
+    for datei in sorted(os.listdir(MANDANTEN_VERZEICHNIS)):
+        name, endung = os.path.splitext(datei)
+        if endung == '.db' and gueltiger_mandant(name):
+            namen.append(name)
+    return namen
+
+
+class PoolVerbindung:
+    """Dünne Hülle um eine sqlite3-Verbindung; close() gibt sie an den Pool zurück"""
+
+    def __init__(self, pool, pfad, conn):
+        self._pool = pool
+        self._pfad = pfad
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *args):
+        return self._conn.__exit__(*args)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.zurueckgeben(self._pfad, self._conn)
+            self._conn = None
+
+
+class Verbindungspool:
+    """
+    Pool ungenutzter Verbindungen je Datenbankdatei.
+
+    Verbindungen werden erst beim ersten Zugriff geöffnet. Sind mehr als
+    max_mandanten Dateien mit freien Verbindungen offen, werden die Verbindungen
+    des am längsten nicht genutzten Mandanten geschlossen. So bleiben
+    Dateihandles und Speicher auch bei vielen Schulen begrenzt.
+
+    beim_oeffnen(conn, pfad) wird für jede neu geöffnete Verbindung aufgerufen.
+    """
+
+    def __init__(self, max_mandanten=MAX_OFFENE_MANDANTEN,
+                 max_pro_mandant=MAX_VERBINDUNGEN_PRO_MANDANT, beim_oeffnen=None):
+        self.max_mandanten = max_mandanten
+        self.max_pro_mandant = max_pro_mandant
+        self.beim_oeffnen = beim_oeffnen
+        self._frei = OrderedDict()  # pfad -> [sqlite3.Connection, ...]
+        self._lock = threading.Lock()
+
+    def _oeffnen(self, pfad):
+        conn = sqlite3.connect(pfad, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        if self.beim_oeffnen is not None:
+            try:
+                self.beim_oeffnen(conn, pfad)
+            except Exception:
+                conn.close()
+                raise
+        return conn
+
+    def holen(self, pfad):
+        """Freie Verbindung aus dem Pool holen oder neu öffnen"""
+        with self._lock:
+            frei = self._frei.get(pfad)
+            if frei is not None:
+                self._frei.move_to_end(pfad)
+                if frei:
+                    return PoolVerbindung(self, pfad, frei.pop())
+        return PoolVerbindung(self, pfad, self._oeffnen(pfad))
+
+    def zurueckgeben(self, pfad, conn):
+        """Verbindung zurücklegen; Überzähliges wird geschlossen"""
+        if conn.in_transaction:
+            conn.rollback()
+        zu_schliessen = []
+        with self._lock:
+            frei = self._frei.setdefault(pfad, [])
+            self._frei.move_to_end(pfad)
+            if len(frei) < self.max_pro_mandant:
+                frei.append(conn)
+            else:
+                zu_schliessen.append(conn)
+            while len(self._frei) > self.max_mandanten:
+                _, alte = self._frei.popitem(last=False)
+                zu_schliessen.extend(alte)
+        for alte_conn in zu_schliessen:
+            alte_conn.close()
+
+    def schliessen(self, pfad=None):
+        """Freie Verbindungen eines Mandanten (oder aller) schließen"""
+        with self._lock:
+            if pfad is None:
+                frei = [c for liste in self._frei.values() for c in liste]
+                self._frei.clear()
+            else:
+                frei = self._frei.pop(pfad, [])
+        for conn in frei:
+            conn.close()
+
+    def statistik(self):
+        with self._lock:
+            return {
+                'offene_mandanten': len(self._frei),
+                'freie_verbindungen': sum(len(l) for l in self._frei.values()),
+            }
+
+
+class MandantenMiddleware:
+    """
+    WSGI-Middleware, die den Mandanten bestimmt und im environ ablegt.
+
+    Im Pfad-Modus wird das Präfix nach SCRIPT_NAME verschoben, damit
+    url_for() automatisch Links mit /<mandant>/ erzeugt. existiert(name)
+    entscheidet, ob ein Mandant eingerichtet ist.
+    """
+
+    def __init__(self, wsgi_app, modus=MANDANTEN_MODUS, existiert=mandant_existiert):
+        self.wsgi_app = wsgi_app
+        self.modus = modus
+        self.existiert = existiert
+
+    def mandant_aus_host(self, environ):
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME', '')
+        return host.split(':', 1)[0].split('.', 1)[0].lower()
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') in PFADE_OHNE_MANDANT:
+            return self.wsgi_app(environ, start_response)
+
+        if self.modus == 'host':
+            mandant = self.mandant_aus_host(environ)
+        elif self.modus == 'pfad':
+            pfad = environ.get('PATH_INFO', '')
+            _, _, rest = pfad.partition('/')
+            mandant, trenner, rest = rest.partition('/')
+            if self.existiert(mandant):
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + '/' + mandant
+                environ['PATH_INFO'] = trenner + rest if trenner else '/'
+        else:
+            return self.wsgi_app(environ, start_response)
+
+        if not self.existiert(mandant):
+            start_response('404 Not Found', [('Content-Type', 'text/plain; charset=utf-8')])
+            return ['Schule nicht gefunden.'.encode('utf-8')]
+
+        environ[ENVIRON_SCHLUESSEL] = mandant
+        return self.wsgi_app(environ, start_response)
@@ -0,0 +1,334 @@
+"""
+Datenbankschema und Migrationen.
+
+Die Schema-Version steht in PRAGMA user_version. Jede Migration bringt die
+Datenbank genau eine Version weiter und ist so geschrieben, dass sie auch auf
+Datenbanken älterer install.py-Versionen (user_version 0) funktioniert.
+
+Für PostgreSQL gibt es eine eigene Migrationsliste (siehe unten).
+"""
+
+import sqlite3
+
+
+def _migration_1(cursor):
+    """Grundschema: Jahrgänge, Schülerdaten, Admins"""
+    # Bestehende Tabelle um fehlende Spalten ergänzen
+    cursor.execute("PRAGMA table_info(schueler_daten)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if columns:
+        if 'datenschutz_einwilligung' not in columns:
+            cursor.execute('ALTER TABLE schueler_daten ADD COLUMN datenschutz_einwilligung BOOLEAN NOT NULL DEFAULT 1')
+        if 'datenschutz_datum' not in columns:
+            # ALTER TABLE erlaubt keinen CURRENT_TIMESTAMP-Default
+            cursor.execute('ALTER TABLE schueler_daten ADD COLUMN datenschutz_datum TIMESTAMP')
+            cursor.execute('UPDATE schueler_daten SET datenschutz_datum = erstellt_am')
+
+    # Tabelle für Abitur-Jahrgänge
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS abitur_jahrgaenge (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            jahrgang INTEGER UNIQUE NOT NULL,
+            aktiv BOOLEAN DEFAULT 1
+        )
+    ''')
+
+    # Tabelle für Schülerdaten
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schueler_daten (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            jahrgang_id INTEGER NOT NULL,
+            vorname TEXT NOT NULL,
+            nachname TEXT NOT NULL,
+            email TEXT NOT NULL,
+            datenschutz_einwilligung BOOLEAN NOT NULL DEFAULT 1,
+            datenschutz_datum TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            erstellt_am TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (jahrgang_id) REFERENCES abitur_jahrgaenge (id)
+        )
+    ''')
+
+    # Admin-Tabelle
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admins (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            benutzername TEXT UNIQUE NOT NULL,
+            passwort_hash TEXT NOT NULL
+        )
+    ''')
+
+
+def _migration_2(cursor):
+    """Index für Abfragen und Verschiebungen je Jahrgang"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_schueler_jahrgang ON schueler_daten (jahrgang_id)')
+
+
+def _migration_3(cursor):
+    """Aufbewahrung: Index auf datenschutz_datum und Protokolltabelle"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_schueler_datenschutz ON schueler_daten (datenschutz_datum)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS aufbewahrung_protokoll (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            zeitpunkt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            regel TEXT NOT NULL,
+            aktion TEXT NOT NULL,
+            schueler_id INTEGER NOT NULL,
+            jahrgang_id INTEGER NOT NULL,
+            datenschutz_datum TIMESTAMP
+        )
+    ''')
+
+
+def _migration_4(cursor):
+    """Aufbewahrung: Teilindex nur über noch nicht anonymisierte Einträge"""
+    # Anonymisierte Einträge (email = '') bleiben sonst im Indexbereich von
+    # datenschutz_datum und werden bei jedem Lauf erneut durchsucht
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_schueler_nicht_anonym ON schueler_daten (datenschutz_datum) "
+                   "WHERE email <> ''")
+
+
+def _migration_5(cursor):
+    """Eigene Spalte für den Widerruf; datenschutz_datum bleibt das Datum der Einwilligung"""
+    cursor.execute("PRAGMA table_info(schueler_daten)")
+    if 'widerrufen_am' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE schueler_daten ADD COLUMN widerrufen_am TIMESTAMP')
+        # Bisher überschrieb der Widerruf datenschutz_datum. Die Einwilligung wird
+        # nur bei der Anmeldung erteilt, ihr Datum ist also erstellt_am.
+        cursor.execute('''
+            UPDATE schueler_daten SET widerrufen_am = datenschutz_datum, datenschutz_datum = erstellt_am
+            WHERE NOT datenschutz_einwilligung
+        ''')
+
+
+def _migration_6(cursor):
+    """Aufbewahrung: Indizes für Regeln ab dem Widerruf (widerrufen_am)"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_schueler_widerrufen ON schueler_daten (widerrufen_am)')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_schueler_widerrufen_nicht_anonym ON schueler_daten (widerrufen_am) "
+                   "WHERE email <> ''")
+
+
+MIGRATIONEN = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+]
+SCHEMA_VERSION = len(MIGRATIONEN)
+
+
+def schema_version(conn):
+    """Aktuelle Schema-Version der Datenbank"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def schema_aktualisieren(conn):
+    """
+    Führt alle ausstehenden Migrationen aus.
+
+    Gibt (alte_version, neue_version) zurück. Jede Migration läuft in einer
+    eigenen Transaktion zusammen mit dem Hochsetzen der Version. Die Version
+    wird erst unter der Schreibsperre (BEGIN IMMEDIATE) gelesen, damit
+    mehrere gleichzeitig startende Prozesse nacheinander migrieren statt
+    sich gegenseitig zu blockieren.
+    """
+    alte_version = None
+    while True:
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            version = schema_version(conn)
+            if alte_version is None:
+                alte_version = version
+            if version > SCHEMA_VERSION:
+                raise sqlite3.DatabaseError(
+                    f'Datenbank hat Schema-Version {version}, diese Programmversion kennt nur {SCHEMA_VERSION}')
+            if version == SCHEMA_VERSION:
+                cursor.execute('COMMIT')
+                return alte_version, SCHEMA_VERSION
+            MIGRATIONEN[version](cursor)
+            cursor.execute(f'PRAGMA user_version = {version + 1}')
+            cursor.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            raise
+
+
+#===========================================================
+#                       PostgreSQL
+#===========================================================
+# Die Version steht in <schema>.schema_info, weil es kein user_version gibt.
+# Jede Funktion bekommt den Cursor und den bereits gequoteten Schemanamen.
+
+def _postgres_migration_1(cursor, s):
+    """Grundschema inkl. Archivtabelle und Index je Jahrgang (entspricht SQLite-Version 2)"""
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {s}.abitur_jahrgaenge (
+            id SERIAL PRIMARY KEY,
+            jahrgang INTEGER UNIQUE NOT NULL,
+            aktiv BOOLEAN NOT NULL DEFAULT TRUE
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {s}.schueler_daten (
+            id SERIAL PRIMARY KEY,
+            jahrgang_id INTEGER NOT NULL REFERENCES {s}.abitur_jahrgaenge (id),
+            vorname TEXT NOT NULL,
+            nachname TEXT NOT NULL,
+            email TEXT NOT NULL,
+            datenschutz_einwilligung BOOLEAN NOT NULL DEFAULT TRUE,
+            datenschutz_datum TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            erstellt_am TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {s}.schueler_daten_archiv (
+            id INTEGER PRIMARY KEY,
+            jahrgang_id INTEGER NOT NULL,
+            vorname TEXT NOT NULL,
+            nachname TEXT NOT NULL,
+            email TEXT NOT NULL,
+            datenschutz_einwilligung BOOLEAN NOT NULL DEFAULT TRUE,
+            datenschutz_datum TIMESTAMP,
+            erstellt_am TIMESTAMP
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {s}.admins (
+            id SERIAL PRIMARY KEY,
+            benutzername TEXT UNIQUE NOT NULL,
+            passwort_hash TEXT NOT NULL
+        )
+    ''')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_schueler_jahrgang ON {s}.schueler_daten (jahrgang_id)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_archiv_jahrgang ON {s}.schueler_daten_archiv (jahrgang_id)')
+    spalten = ('id, jahrgang_id, vorname, nachname, email, '
+               'datenschutz_einwilligung, datenschutz_datum, erstellt_am')
+    cursor.execute(f'''
+        CREATE OR REPLACE VIEW {s}.alle_schueler_daten AS
+        SELECT {spalten}, 0 AS archiviert FROM {s}.schueler_daten
+        UNION ALL
+        SELECT {spalten}, 1 AS archiviert FROM {s}.schueler_daten_archiv
+    ''')
+
+
+def _postgres_migration_2(cursor, s):
+    """Aufbewahrung: Indizes auf datenschutz_datum und Protokolltabelle"""
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_schueler_datenschutz ON {s}.schueler_daten (datenschutz_datum)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_archiv_datenschutz ON {s}.schueler_daten_archiv (datenschutz_datum)')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {s}.aufbewahrung_protokoll (
+            id SERIAL PRIMARY KEY,
+            zeitpunkt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            regel TEXT NOT NULL,
+            aktion TEXT NOT NULL,
+            schueler_id INTEGER NOT NULL,
+            jahrgang_id INTEGER NOT NULL,
+            datenschutz_datum TIMESTAMP
+        )
+    ''')
+
+
+def _postgres_migration_3(cursor, s):
+    """Aufbewahrung: Teilindizes nur über noch nicht anonymisierte Einträge"""
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_schueler_nicht_anonym ON {s}.schueler_daten (datenschutz_datum) "
+                   f"WHERE email <> ''")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_archiv_nicht_anonym ON {s}.schueler_daten_archiv (datenschutz_datum) "
+                   f"WHERE email <> ''")
+
+
+def _postgres_migration_4(cursor, s):
+    """Eigene Spalte für den Widerruf (entspricht SQLite-Version 5), Sicht neu anlegen"""
+    for tabelle in ('schueler_daten', 'schueler_daten_archiv'):
+        cursor.execute(f'ALTER TABLE {s}.{tabelle} ADD COLUMN IF NOT EXISTS widerrufen_am TIMESTAMP')
+        cursor.execute(f'''
+            UPDATE {s}.{tabelle} SET widerrufen_am = datenschutz_datum, datenschutz_datum = erstellt_am
+            WHERE NOT datenschutz_einwilligung AND widerrufen_am IS NULL
+        ''')
+    # CREATE OR REPLACE VIEW kann keine Spalte vor 'archiviert' einfügen
+    cursor.execute(f'DROP VIEW IF EXISTS {s}.alle_schueler_daten')
+    spalten = ('id, jahrgang_id, vorname, nachname, email, '
+               'datenschutz_einwilligung, datenschutz_datum, erstellt_am, widerrufen_am')
+    cursor.execute(f'''
+        CREATE VIEW {s}.alle_schueler_daten AS
+        SELECT {spalten}, 0 AS archiviert FROM {s}.schueler_daten
+        UNION ALL
+        SELECT {spalten}, 1 AS archiviert FROM {s}.schueler_daten_archiv
+    ''')
+
+
+def _postgres_migration_5(cursor, s):
+    """Aufbewahrung: Indizes für Regeln ab dem Widerruf (entspricht SQLite-Version 6)"""
+    for tabelle, praefix in (('schueler_daten', 'schueler'), ('schueler_daten_archiv', 'archiv')):
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{praefix}_widerrufen ON {s}.{tabelle} (widerrufen_am)')
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{praefix}_widerrufen_nicht_anonym ON {s}.{tabelle} "
+                       f"(widerrufen_am) WHERE email <> ''")
+
+
+def _postgres_migration_6(cursor, s):
+    """
+    Zeitpunkte in UTC speichern wie bei SQLite (CURRENT_TIMESTAMP).
+
+    Bisher stand in den TIMESTAMP-Spalten die Ortszeit der Sitzung. Vorhandene
+    Werte werden aus der aktuellen Zeitzone (TimeZone) nach UTC umgerechnet.
+    """
+    utc = "(now() AT TIME ZONE 'utc')"
+    umrechnen = "({0} AT TIME ZONE current_setting('TimeZone')) AT TIME ZONE 'utc'"
+    zeitspalten = {
+        'schueler_daten': ('datenschutz_datum', 'erstellt_am', 'widerrufen_am'),
+        'schueler_daten_archiv': ('datenschutz_datum', 'erstellt_am', 'widerrufen_am'),
+        'aufbewahrung_protokoll': ('zeitpunkt', 'datenschutz_datum'),
+    }
+    for tabelle, spalten in zeitspalten.items():
+        zuweisungen = ', '.join(f'{spalte} = {umrechnen.format(spalte)}' for spalte in spalten)
+        cursor.execute(f'UPDATE {s}.{tabelle} SET {zuweisungen}')
+    for tabelle, spalte in (('schueler_daten', 'datenschutz_datum'), ('schueler_daten', 'erstellt_am'),
+                            ('aufbewahrung_protokoll', 'zeitpunkt')):
+        cursor.execute(f'ALTER TABLE {s}.{tabelle} ALTER COLUMN {spalte} SET DEFAULT {utc}')
+
+
+POSTGRES_MIGRATIONEN = [
+    _postgres_migration_1,
+    _postgres_migration_2,
+    _postgres_migration_3,
+    _postgres_migration_4,
+    _postgres_migration_5,
+    _postgres_migration_6,
+]
+POSTGRES_SCHEMA_VERSION = len(POSTGRES_MIGRATIONEN)
+
+
+def postgres_schema_aktualisieren(conn, s):
+    """
+    Legt das Schema s an (falls nötig) und führt ausstehende Migrationen aus.
+
+    s ist der bereits gequotete Schemaname. Gibt (alte_version, neue_version) zurück.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {s}')
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {s}.schema_info (version INTEGER NOT NULL)')
+        # Sperre verhindert, dass zwei Prozesse gleichzeitig migrieren
+        cursor.execute(f'LOCK TABLE {s}.schema_info IN EXCLUSIVE MODE')
+        cursor.execute(f'SELECT version FROM {s}.schema_info')
+        zeile = cursor.fetchone()
+        if zeile is None:
+            cursor.execute(f'INSERT INTO {s}.schema_info (version) VALUES (0)')
+            alte_version = 0
+        else:
+            alte_version = zeile[0]
+        if alte_version > POSTGRES_SCHEMA_VERSION:
+            conn.rollback()
+            raise RuntimeError(
+                f'Datenbank hat Schema-Version {alte_version}, diese Programmversion kennt nur {POSTGRES_SCHEMA_VERSION}')
+
+        try:
+            for version in range(alte_version, POSTGRES_SCHEMA_VERSION):
+                POSTGRES_MIGRATIONEN[version](cursor, s)
+            cursor.execute(f'UPDATE {s}.schema_info SET version = %s', (POSTGRES_SCHEMA_VERSION,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return alte_version, POSTGRES_SCHEMA_VERSION
@@ -0,0 +1,117 @@
+"""
+Schutz des öffentlichen Formulars (/submit) vor Spam und Überlastung.
+
+- Token-Bucket-Ratenbegrenzung je Client-IP und je E-Mail-Adresse
+- Signiertes, zustandsloses Formular-Token (HMAC mit Zeitstempel)
+- Honeypot-Feld, das nur Bots ausfüllen
+- Zähler für abgewiesene Anfragen
+
+Alle Prüfungen kommen ohne Datenbank aus, damit Müll abgewiesen wird,
+bevor eine Verbindung geöffnet wird.
+"""
+
+import hashlib
+import hmac
+import time
+from collections import OrderedDict
+
+HONEYPOT_FELD = 'webseite'
+TOKEN_FELD = 'formular_token'
+TOKEN_MIN_ALTER = 2          # Sekunden; schneller füllt kein Mensch das Formular aus
+TOKEN_MAX_ALTER = 2 * 3600   # Sekunden
+
+# Ergebnisse von formular_token_pruefen()
+TOKEN_OK = 'ok'
+TOKEN_UNGUELTIG = 'ungueltig'
+TOKEN_ZU_FRUEH = 'zu_frueh'
+TOKEN_ABGELAUFEN = 'abgelaufen'
+
+
+class RateLimiter:
+    """
+    Token-Bucket je Schlüssel mit begrenzter Anzahl gemerkter Schlüssel.
+
+    Der Zustand eines Schlüssels ist ein unveränderliches Tupel
+    (tokens, zeitpunkt), das als Ganzes ersetzt wird. Einzelne dict-Operationen
+    sind unter dem GIL atomar, daher kommt der Limiter ohne Lock aus; bei
+    gleichzeitigen Anfragen desselben Schlüssels kann höchstens ein Token zu
+    viel vergeben werden. Sind mehr als max_schluessel Einträge gespeichert,
+    fallen die am längsten ungenutzten heraus (LRU).
+    """
+
+    def __init__(self, rate, kapazitaet, max_schluessel=10000):
+        self.rate = rate              # Tokens pro Sekunde
+        self.kapazitaet = kapazitaet
+        self.max_schluessel = max_schluessel
+        self._buckets = OrderedDict()
+
+    def erlauben(self, schluessel, jetzt=None):
+        """Verbraucht ein Token; False, wenn der Bucket leer ist"""
+        jetzt = time.monotonic() if jetzt is None else jetzt
+        tokens, zuletzt = self._buckets.get(schluessel, (self.kapazitaet, jetzt))
+        tokens = min(self.kapazitaet, tokens + (jetzt - zuletzt) * self.rate)
+        erlaubt = tokens >= 1
+        if erlaubt:
+            tokens -= 1
+        self._buckets[schluessel] = (tokens, jetzt)
+        try:
+            self._buckets.move_to_end(schluessel)
+        except KeyError:
+            pass
+        while len(self._buckets) > self.max_schluessel:
+            try:
+                self._buckets.popitem(last=False)
+            except KeyError:
+                break
+        return erlaubt
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def email_normalisieren(email):
+    """Kleinschreibung und ohne +Zusatz, damit Varianten einer Adresse zusammenfallen"""
+    email = (email or '').strip().lower()
+    lokal, at, domain = email.rpartition('@')
+    if not at:
+        return email
+    return lokal.split('+', 1)[0] + '@' + domain
+
+
+def _signatur(secret, nachricht):
+    return hmac.new(secret.encode(), nachricht.encode(), hashlib.sha256).hexdigest()
+
+
+def formular_token_erstellen(secret, kontext='', jetzt=None):
+    """Token aus Zeitstempel und HMAC; kontext bindet es z. B. an den Mandanten"""
+    zeitstempel = str(int(time.time() if jetzt is None else jetzt))
+    return f'{zeitstempel}.{_signatur(secret, f"{kontext}:{zeitstempel}")}'
+
+
+def formular_token_pruefen(secret, token, kontext='', jetzt=None):
+    """Prüft Signatur und Alter des Tokens; gibt eines der TOKEN_*-Ergebnisse zurück"""
+    zeitstempel, _, signatur = (token or '').partition('.')
+    if not zeitstempel.isdecimal() or not signatur:
+        return TOKEN_UNGUELTIG
+    erwartet = _signatur(secret, f'{kontext}:{zeitstempel}')
+    if not hmac.compare_digest(signatur, erwartet):
+        return TOKEN_UNGUELTIG
+    alter = (time.time() if jetzt is None else jetzt) - int(zeitstempel)
+    if alter < TOKEN_MIN_ALTER:
+        return TOKEN_ZU_FRUEH
+    if alter > TOKEN_MAX_ALTER:
+        return TOKEN_ABGELAUFEN
+    return TOKEN_OK
+
+
+class Abweisungszaehler:
+    """Zählt abgewiesene Anfragen nach Grund (Näherungswerte, ohne Lock)"""
+
+    def __init__(self):
+        self._zaehler = {}
+
+    def erhoehen(self, grund):
+        self._zaehler[grund] = self._zaehler.get(grund, 0) + 1
+
+    def als_dict(self):
+        return dict(self._zaehler)
@@ -0,0 +1,714 @@
+"""
+Datenzugriffsschicht.
+
+Alle SQL-Abfragen der Anwendung liegen hier statt in den Flask-Views. Die
+Basisklasse Speicher enthält die Abfragen einmal; SqliteSpeicher und
+PostgresSpeicher liefern nur Verbindungen, Tabellennamen und die wenigen
+Unterschiede der Dialekte.
+
+Auswahl über Umgebungsvariablen:
+- SPEICHER=sqlite (Standard): eine Datei je Mandant, Archiv per ATTACH
+- SPEICHER=postgres: POSTGRES_DSN, ein Schema je Mandant, Verbindungspool
+  mit POSTGRES_MIN_VERBINDUNGEN bis POSTGRES_MAX_VERBINDUNGEN
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+import archiv
+import mandanten
+import schema
+
+SPEICHER = os.environ.get('SPEICHER', 'sqlite').strip().lower()
+SQLITE_DATENBANK = 'database.db'
+POSTGRES_DSN = os.environ.get('POSTGRES_DSN', '')
+POSTGRES_MIN_VERBINDUNGEN = int(os.environ.get('POSTGRES_MIN_VERBINDUNGEN', '1'))
+POSTGRES_MAX_VERBINDUNGEN = int(os.environ.get('POSTGRES_MAX_VERBINDUNGEN', '10'))
+POSTGRES_MANDANTEN_PRAEFIX = 'mandant_'
+
+IN_BLOCK_GROESSE = 500  # unter dem Variablenlimit älterer SQLite-Versionen (999)
+EXPORT_ITERSIZE = 1000  # Zeilen pro Abruf beim serverseitigen Export-Cursor
+MAX_VORWAERM_BYTES = 64 * 1024 * 1024
+BULK_AKTIONEN = ('loeschen', 'verschieben', 'einwilligung_widerrufen')
+AUFBEWAHRUNG_AKTIONEN = ('loeschen', 'anonymisieren')
+ANONYM = 'Anonymisiert'  # Ersatz für Vor- und Nachname; die E-Mail wird geleert
+
+
+class DoppelterEintrag(Exception):
+    """Jahrgang oder Benutzername existiert bereits"""
+
+
+def _in_bloecken(werte, groesse=IN_BLOCK_GROESSE):
+    """Liste in Blöcke für IN (...)-Abfragen aufteilen"""
+    for start in range(0, len(werte), groesse):
+        yield werte[start:start + groesse]
+
+
+class Speicher:
+    """
+    Gemeinsame Abfragen für alle Backends.
+
+    SQL wird mit ? als Platzhalter und {tabelle} für Tabellennamen
+    geschrieben; _sql() setzt beides für das jeweilige Backend ein.
+    Unterklassen liefern _lesen(), _transaktion() und _export_cursor()
+    (oder eine eigene export_zeilen()).
+    """
+
+    tabellen = {}
+    LIKE = 'LIKE'
+    SPERRE = ''  # Zusatz für SELECT, der ausgewählte Zeilen bis zum Commit sperrt
+    JETZT = 'CURRENT_TIMESTAMP'  # aktueller Zeitpunkt in UTC, wie die Stichtage der Aufbewahrung
+    INTEGRITAETSFEHLER = ()
+
+    def _sql(self, sql):
+        return sql.format(**self.tabellen)
+
+    def _ausfuehren(self, cur, sql, parameter=()):
+        cur.execute(self._sql(sql), parameter)
+        return cur
+
+    #-------------------------- Jahrgänge --------------------------
+    def aktive_jahrgaenge(self):
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, 'SELECT * FROM {jahrgaenge} WHERE aktiv ORDER BY jahrgang DESC').fetchall()
+
+    def alle_jahrgaenge(self):
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, 'SELECT id, jahrgang, aktiv FROM {jahrgaenge} ORDER BY jahrgang DESC').fetchall()
+
+    def jahrgaenge_uebersicht(self):
+        """Alle Jahrgänge mit Anzahl aktiver und archivierter Schüler"""
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, '''
+                SELECT a.*, COALESCE(h.anzahl, 0) + COALESCE(r.anzahl, 0) as schueler_anzahl,
+                       COALESCE(r.anzahl, 0) as archiviert_anzahl
+                FROM {jahrgaenge} a
+                LEFT JOIN (SELECT jahrgang_id, COUNT(*) as anzahl FROM {schueler} GROUP BY jahrgang_id) h
+                    ON a.id = h.jahrgang_id
+                LEFT JOIN (SELECT jahrgang_id, COUNT(*) as anzahl FROM {archiv} GROUP BY jahrgang_id) r
+                    ON a.id = r.jahrgang_id
+                ORDER BY a.jahrgang DESC
+            ''').fetchall()
+
+    def jahrgang_finden(self, jahrgang_id):
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, 'SELECT * FROM {jahrgaenge} WHERE id = ?', (jahrgang_id,)).fetchone()
+
+    def jahrgang_hinzufuegen(self, jahrgang):
+        try:
+            with self._transaktion() as cur:
+                self._ausfuehren(cur, 'INSERT INTO {jahrgaenge} (jahrgang) VALUES (?)', (jahrgang,))
+        except self.INTEGRITAETSFEHLER as e:
+            raise DoppelterEintrag(str(e)) from e
+
+    def jahrgang_aktiv_setzen(self, jahrgang_id, aktiv):
+        with self._transaktion() as cur:
+            self._ausfuehren(cur, 'UPDATE {jahrgaenge} SET aktiv = ? WHERE id = ?', (bool(aktiv), jahrgang_id))
+
+    def jahrgang_loeschen(self, jahrgang_id):
+        """Jahrgang samt aktiven und archivierten Schülern löschen; gibt die Schüleranzahl zurück"""
+        with self._transaktion() as cur:
+            anzahl = self._ausfuehren(cur, 'DELETE FROM {schueler} WHERE jahrgang_id = ?', (jahrgang_id,)).rowcount
+            anzahl += self._ausfuehren(cur, 'DELETE FROM {archiv} WHERE jahrgang_id = ?', (jahrgang_id,)).rowcount
+            self._ausfuehren(cur, 'DELETE FROM {jahrgaenge} WHERE id = ?', (jahrgang_id,))
+        return anzahl
+
+    #--------------------------- Archiv ----------------------------
+    def _ids_verschieben(self, cur, quelle, ziel, ids):
+        """
+        Zeilen mit den angegebenen ids zwischen {schueler} und {archiv} verschieben.
+
+        Steuert keine Transaktion. Vorher werden Reste im Ziel entfernt, die
+        noch in der Quelle stehen, damit ein abgebrochener Lauf gefahrlos
+        wiederholt werden kann.
+        """
+        if not ids:
+            return 0
+        platzhalter = ','.join('?' * len(ids))
+        spalten = archiv.SPALTEN
+        self._ausfuehren(cur, f'''
+            DELETE FROM {{{ziel}}}
+            WHERE id IN (SELECT id FROM {{{quelle}}} WHERE id IN ({platzhalter}))
+        ''', ids)
+        self._ausfuehren(cur, f'''
+            INSERT INTO {{{ziel}}} ({spalten})
+            SELECT {spalten} FROM {{{quelle}}} WHERE id IN ({platzhalter})
+        ''', ids)
+        return self._ausfuehren(cur, f'DELETE FROM {{{quelle}}} WHERE id IN ({platzhalter})', ids).rowcount
+
+    def _jahrgang_verschieben(self, quelle, ziel, jahrgang_id, batch):
+        """Zeilen eines Jahrgangs in Stapeln verschieben; jeder Stapel ist eine Transaktion"""
+        verschoben = 0
+        while True:
+            with self._transaktion() as cur:
+                ids = [row['id'] for row in self._ausfuehren(
+                    cur, f'SELECT id FROM {{{quelle}}} WHERE jahrgang_id = ? ORDER BY id LIMIT ?',
+                    (jahrgang_id, batch)).fetchall()]
+                self._ids_verschieben(cur, quelle, ziel, ids)
+            verschoben += len(ids)
+            if len(ids) < batch:
+                return verschoben
+
+    def jahrgang_archivieren(self, jahrgang_id, batch=archiv.ARCHIV_BATCH):
+        """Schülerdaten eines Jahrgangs ins Archiv verschieben; gibt die Anzahl zurück"""
+        return self._jahrgang_verschieben('schueler', 'archiv', jahrgang_id, batch)
+
+    def jahrgang_wiederherstellen(self, jahrgang_id, batch=archiv.ARCHIV_BATCH):
+        """Schülerdaten eines Jahrgangs aus dem Archiv zurückholen; gibt die Anzahl zurück"""
+        return self._jahrgang_verschieben('archiv', 'schueler', jahrgang_id, batch)
+
+    def inaktive_archivieren(self, batch=archiv.ARCHIV_BATCH):
+        """Altbestand: Zeilen bereits inaktiver Jahrgänge ins Archiv verschieben"""
+        with self._lesen() as cur:
+            jahrgang_ids = [row['jahrgang_id'] for row in self._ausfuehren(cur, '''
+                SELECT DISTINCT s.jahrgang_id
+                FROM {schueler} s
+                JOIN {jahrgaenge} a ON s.jahrgang_id = a.id
+                WHERE NOT a.aktiv
+            ''').fetchall()]
+        return sum(self.jahrgang_archivieren(jahrgang_id, batch) for jahrgang_id in jahrgang_ids)
+
+    def aktive_wiederherstellen(self, batch=archiv.ARCHIV_BATCH):
+        """Gegenstück: Archivzeilen aktiver Jahrgänge zurückholen (z. B. nach abgebrochener Aktivierung)"""
+        with self._lesen() as cur:
+            jahrgang_ids = [row['jahrgang_id'] for row in self._ausfuehren(cur, '''
+                SELECT DISTINCT r.jahrgang_id
+                FROM {archiv} r
+                JOIN {jahrgaenge} a ON r.jahrgang_id = a.id
+                WHERE a.aktiv
+            ''').fetchall()]
+        return sum(self.jahrgang_wiederherstellen(jahrgang_id, batch) for jahrgang_id in jahrgang_ids)
+
+    #--------------------------- Schüler ---------------------------
+    def schueler_hinzufuegen(self, jahrgang_id, vorname, nachname, email):
+        """Neuen Eintrag anlegen; gibt False zurück, wenn der Jahrgang nicht (mehr) aktiv ist"""
+        with self._transaktion() as cur:
+            # Prüfung und INSERT in einem Schritt, damit nichts mehr in einen
+            # gerade deaktivierten (und archivierten) Jahrgang geschrieben wird
+            return self._ausfuehren(cur, '''
+                INSERT INTO {schueler} (jahrgang_id, vorname, nachname, email, datenschutz_einwilligung)
+                SELECT ?, ?, ?, ?, ? FROM {jahrgaenge} WHERE id = ? AND aktiv
+            ''', (jahrgang_id, vorname, nachname, email, True, jahrgang_id)).rowcount == 1
+
+    def schueler_liste(self):
+        """Aktive (nicht archivierte) Schüler mit Jahrgang, neueste zuerst"""
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, '''
+                SELECT s.*, a.jahrgang, 0 as archiviert
+                FROM {schueler} s
+                JOIN {jahrgaenge} a ON s.jahrgang_id = a.id
+                ORDER BY s.erstellt_am DESC
+            ''').fetchall()
+
+    def schueler_suchen(self, suche):
+        """Suche nach Name oder E-Mail über aktive und archivierte Einträge"""
+        muster = f'%{suche}%'
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, f'''
+                SELECT s.*, a.jahrgang
+                FROM {{alle}} s
+                JOIN {{jahrgaenge}} a ON s.jahrgang_id = a.id
+                WHERE s.vorname {self.LIKE} ? OR s.nachname {self.LIKE} ? OR s.email {self.LIKE} ?
+                ORDER BY s.erstellt_am DESC
+            ''', (muster, muster, muster)).fetchall()
+
+    def statistik(self):
+        """Alle Registrierungen (inkl. Archiv) und Jahrgänge mit aktiven Einträgen"""
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, '''
+                SELECT
+                    (SELECT COUNT(*) FROM {alle}) as total_schueler,
+                    (SELECT COUNT(DISTINCT jahrgang_id) FROM {schueler}) as aktive_jahrgaenge
+            ''').fetchone()
+
+    def schueler_loeschen(self, schueler_id):
+        with self._transaktion() as cur:
+            self._ausfuehren(cur, 'DELETE FROM {schueler} WHERE id = ?', (schueler_id,))
+            self._ausfuehren(cur, 'DELETE FROM {archiv} WHERE id = ?', (schueler_id,))
+
+    def bulk(self, aktion, ids, ziel_jahrgang_id=None):
+        """
+        Führt eine Sammelaktion in einer Transaktion über beide Bereiche aus.
+
+        Gibt ein dict mit den Anzahlen betroffener, unveränderter (z. B. schon
+        widerrufener) und nicht gefundener Einträge zurück.
+        """
+        if aktion not in BULK_AKTIONEN:
+            raise ValueError(f'Unbekannte Aktion: {aktion}')
+        betroffen = vorhanden = 0
+        with self._transaktion() as cur:
+            if aktion == 'verschieben':
+                ziel = self._ausfuehren(cur, 'SELECT aktiv FROM {jahrgaenge} WHERE id = ?',
+                                        (ziel_jahrgang_id,)).fetchone()
+                if not ziel:
+                    raise ValueError('Ziel-Jahrgang nicht gefunden')
+                # Einträge müssen im Bereich liegen, der zum Ziel-Jahrgang passt
+                quelle, ziel_bereich = ('archiv', 'schueler') if ziel['aktiv'] else ('schueler', 'archiv')
+
+            for block in _in_bloecken(ids):
+                platzhalter = ','.join('?' * len(block))
+                vorhanden += self._ausfuehren(
+                    cur, f'SELECT COUNT(*) as anzahl FROM {{alle}} WHERE id IN ({platzhalter})',
+                    block).fetchone()['anzahl']
+                if aktion == 'loeschen':
+                    for bereich in ('schueler', 'archiv'):
+                        betroffen += self._ausfuehren(
+                            cur, f'DELETE FROM {{{bereich}}} WHERE id IN ({platzhalter})', block).rowcount
+                elif aktion == 'verschieben':
+                    self._ids_verschieben(cur, quelle, ziel_bereich, block)
+                    # Zeilen, die schon im Ziel-Jahrgang sind, zählen als unverändert
+                    betroffen += self._ausfuehren(cur, f'''
+                        UPDATE {{{ziel_bereich}}} SET jahrgang_id = ?
+                        WHERE id IN ({platzhalter}) AND jahrgang_id <> ?
+                    ''', [ziel_jahrgang_id] + list(block) + [ziel_jahrgang_id]).rowcount
+                elif aktion == 'einwilligung_widerrufen':
+                    for bereich in ('schueler', 'archiv'):
+                        betroffen += self._ausfuehren(cur, f'''
+                            UPDATE {{{bereich}}}
+                            SET datenschutz_einwilligung = ?, widerrufen_am = {self.JETZT}
+                            WHERE id IN ({platzhalter}) AND datenschutz_einwilligung
+                        ''', [False] + list(block)).rowcount
+        return {
+            'betroffen': betroffen,
+            'unveraendert': vorhanden - betroffen,
+            'nicht_gefunden': len(ids) - vorhanden,
+        }
+
+    #--------------------------- Export ----------------------------
+    EXPORT_SPALTEN = '''
+        s.id, s.jahrgang_id, a.jahrgang, s.vorname, s.nachname, s.email,
+        COALESCE(s.datenschutz_einwilligung, TRUE) as datenschutz_einwilligung,
+        COALESCE(s.datenschutz_datum, s.erstellt_am) as datenschutz_datum,
+        s.widerrufen_am, s.erstellt_am
+    '''
+
+    def _export_abfrage(self, jahrgang_id=None, spalten=EXPORT_SPALTEN):
+        sql = f'''
+            SELECT {spalten}
+            FROM {{alle}} s
+            JOIN {{jahrgaenge}} a ON s.jahrgang_id = a.id
+        '''
+        if jahrgang_id is None:
+            return sql + ' ORDER BY a.jahrgang DESC, s.nachname, s.vorname', ()
+        return sql + ' WHERE s.jahrgang_id = ? ORDER BY s.nachname, s.vorname', (jahrgang_id,)
+
+    def export_anzahl(self, jahrgang_id=None):
+        with self._lesen() as cur:
+            if jahrgang_id is None:
+                return self._ausfuehren(cur, 'SELECT COUNT(*) as anzahl FROM {alle}').fetchone()['anzahl']
+            return self._ausfuehren(cur, 'SELECT COUNT(*) as anzahl FROM {alle} WHERE jahrgang_id = ?',
+                                    (jahrgang_id,)).fetchone()['anzahl']
+
+    def export_zeilen(self, jahrgang_id=None):
+        """Exportzeilen als Generator, ohne alles in den Speicher zu laden"""
+        sql, parameter = self._export_abfrage(jahrgang_id)
+        with self._export_cursor() as cur:
+            self._ausfuehren(cur, sql, parameter)
+            for zeile in cur:
+                yield zeile
+
+    #------------------------ Aufbewahrung -------------------------
+    def _aufbewahrung_bedingung(self, widerrufen, aktion):
+        """WHERE-Bedingung und Datumsspalte einer Regel; der Stichtag ist der einzige Parameter"""
+        if aktion not in AUFBEWAHRUNG_AKTIONEN:
+            raise ValueError(f'Unbekannte Aktion: {aktion}')
+        # 'jahre' zählt immer ab der Einwilligung, 'widerrufen' ab dem Widerruf
+        # (widerrufen_am ist nur bei widerrufener Einwilligung gesetzt)
+        spalte = 'widerrufen_am' if widerrufen else 'datenschutz_datum'
+        bedingung = f'{spalte} < ?'
+        if aktion == 'anonymisieren':
+            # Bereits anonymisierte Einträge haben keine E-Mail mehr. Die Bedingung
+            # entspricht wörtlich den Teilindizes idx_*_nicht_anonym (schema.py,
+            # archiv.py), sonst nutzt SQLite sie nicht.
+            bedingung += " AND email <> ''"
+        return bedingung, spalte
+
+    def aufbewahrung_zaehlen(self, widerrufen, stichtag, aktion):
+        """Probelauf: betroffene Einträge je Bereich zählen, ohne etwas zu ändern"""
+        bedingung, _ = self._aufbewahrung_bedingung(widerrufen, aktion)
+        with self._lesen() as cur:
+            return {
+                bereich: self._ausfuehren(cur, f'SELECT COUNT(*) as anzahl FROM {{{bereich}}} WHERE {bedingung}',
+                                          (stichtag,)).fetchone()['anzahl']
+                for bereich in ('schueler', 'archiv')
+            }
+
+    def aufbewahrung_stapel(self, bereich, regel, widerrufen, stichtag, aktion, batch):
+        """
+        Einen Stapel fälliger Einträge löschen oder anonymisieren.
+
+        Läuft in einer eigenen, kurzen Transaktion und schreibt je Eintrag eine
+        Zeile ins Protokoll. Gibt die Anzahl bearbeiteter Einträge zurück.
+        """
+        bedingung, spalte = self._aufbewahrung_bedingung(widerrufen, aktion)
+        with self._transaktion() as cur:
+            ids = [row['id'] for row in self._ausfuehren(cur, f'''
+                SELECT id FROM {{{bereich}}}
+                WHERE {bedingung}
+                ORDER BY {spalte}
+                LIMIT ?{self.SPERRE}
+            ''', (stichtag, batch)).fetchall()]
+            if not ids:
+                return 0
+            platzhalter = ','.join('?' * len(ids))
+            self._ausfuehren(cur, f'''
+                INSERT INTO {{protokoll}} (regel, aktion, schueler_id, jahrgang_id, datenschutz_datum)
+                SELECT ?, ?, id, jahrgang_id, datenschutz_datum FROM {{{bereich}}} WHERE id IN ({platzhalter})
+            ''', [regel, aktion] + ids)
+            if aktion == 'loeschen':
+                self._ausfuehren(cur, f'DELETE FROM {{{bereich}}} WHERE id IN ({platzhalter})', ids)
+            else:
+                self._ausfuehren(cur, f'''
+                    UPDATE {{{bereich}}} SET vorname = ?, nachname = ?, email = ''
+                    WHERE id IN ({platzhalter})
+                ''', [ANONYM, ANONYM] + ids)
+        return len(ids)
+
+    def aufbewahrung_protokoll(self, limit=100):
+        """Neueste Protokolleinträge mit Jahrgang (falls noch vorhanden)"""
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, '''
+                SELECT p.*, a.jahrgang
+                FROM {protokoll} p
+                LEFT JOIN {jahrgaenge} a ON p.jahrgang_id = a.id
+                ORDER BY p.id DESC
+                LIMIT ?
+            ''', (limit,)).fetchall()
+
+    #--------------------------- Admins ----------------------------
+    def admin_anmelden(self, benutzername, passwort_hash):
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, 'SELECT * FROM {admins} WHERE benutzername = ? AND passwort_hash = ?',
+                                    (benutzername, passwort_hash)).fetchone()
+
+    def admins(self):
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, 'SELECT id, benutzername FROM {admins} ORDER BY benutzername').fetchall()
+
+    def admin_finden(self, benutzer_id):
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, 'SELECT id, benutzername FROM {admins} WHERE id = ?',
+                                    (benutzer_id,)).fetchone()
+
+    def admin_anzahl(self):
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, 'SELECT COUNT(*) as anzahl FROM {admins}').fetchone()['anzahl']
+
+    def admin_hinzufuegen(self, benutzername, passwort_hash):
+        try:
+            with self._transaktion() as cur:
+                self._ausfuehren(cur, 'INSERT INTO {admins} (benutzername, passwort_hash) VALUES (?, ?)',
+                                 (benutzername, passwort_hash))
+        except self.INTEGRITAETSFEHLER as e:
+            raise DoppelterEintrag(str(e)) from e
+
+    def admin_anlegen_falls_fehlend(self, benutzername, passwort_hash):
+        """Für install.py: Standard-Login anlegen, bestehenden nicht überschreiben"""
+        with self._transaktion() as cur:
+            self._ausfuehren(cur, '''
+                INSERT INTO {admins} (benutzername, passwort_hash) VALUES (?, ?)
+                ON CONFLICT (benutzername) DO NOTHING
+            ''', (benutzername, passwort_hash))
+
+    def admin_passwort_aendern(self, benutzer_id, altes_passwort_hash, neues_passwort_hash):
+        """Gibt den Benutzernamen zurück, oder None wenn das alte Passwort falsch ist"""
+        with self._transaktion() as cur:
+            benutzer = self._ausfuehren(cur, 'SELECT benutzername FROM {admins} WHERE id = ? AND passwort_hash = ?',
+                                        (benutzer_id, altes_passwort_hash)).fetchone()
+            if not benutzer:
+                return None
+            self._ausfuehren(cur, 'UPDATE {admins} SET passwort_hash = ? WHERE id = ?',
+                             (neues_passwort_hash, benutzer_id))
+            return benutzer['benutzername']
+
+    def admin_loeschen(self, benutzer_id):
+        with self._transaktion() as cur:
+            self._ausfuehren(cur, 'DELETE FROM {admins} WHERE id = ?', (benutzer_id,))
+
+    #--------------------------- Betrieb ---------------------------
+    def admin_vorhanden(self):
+        with self._lesen() as cur:
+            return self._ausfuehren(cur, 'SELECT 1 as vorhanden FROM {admins} LIMIT 1').fetchone() is not None
+
+    def vorwaermen(self):
+        """Daten einmal lesen, damit die ersten Anfragen nicht auf die Platte warten"""
+        with self._lesen() as cur:
+            for tabelle in ('jahrgaenge', 'schueler', 'admins'):
+                self._ausfuehren(cur, f'SELECT COUNT(*) as anzahl FROM {{{tabelle}}}').fetchone()
+
+
+#===========================================================
+#                          SQLite
+#===========================================================
+_sqlite_pool = None
+_sqlite_pool_lock = threading.Lock()
+
+
+def sqlite_pool():
+    """Gemeinsamer Verbindungspool für alle SQLite-Dateien"""
+    global _sqlite_pool
+    with _sqlite_pool_lock:
+        if _sqlite_pool is None:
+            _sqlite_pool = mandanten.Verbindungspool(beim_oeffnen=archiv.anhaengen)
+        return _sqlite_pool
+
+
+def sqlite_pfad(mandant=None):
+    """Datenbankdatei des Mandanten, sonst SQLITE_DATENBANK"""
+    if mandant:
+        return mandanten.mandant_datenbank(mandant)
+    return SQLITE_DATENBANK
+
+
+class SqliteSpeicher(Speicher):
+    """Eine Datei je Mandant; Archiv als angehängte Datenbank 'archiv'"""
+
+    INTEGRITAETSFEHLER = (sqlite3.IntegrityError,)
+
+    def __init__(self, pfad, pool=None):
+        self.pfad = pfad
+        self.pool = pool or sqlite_pool()
+        self.tabellen = {
+            'jahrgaenge': 'main.abitur_jahrgaenge',
+            'schueler': 'main.schueler_daten',
+            'archiv': 'archiv.schueler_daten',
+            'alle': 'alle_schueler_daten',
+            'admins': 'main.admins',
+            'protokoll': 'main.aufbewahrung_protokoll',
+        }
+
+    @contextlib.contextmanager
+    def _verbindung(self):
+        conn = self.pool.holen(self.pfad)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def _lesen(self):
+        with self._verbindung() as conn:
+            yield conn.cursor()
+
+    @contextlib.contextmanager
+    def _transaktion(self):
+        with self._verbindung() as conn:
+            cur = conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                yield cur
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def export_zeilen(self, jahrgang_id=None):
+        """
+        Exportzeilen seitenweise, ohne während des Downloads eine Sperre zu halten.
+
+        Ein offener SELECT hielte die Lesesperre, bis der Client fertig
+        geladen hat, und würde solange jedes INSERT blockieren. Deshalb
+        werden erst nur die ids in Exportreihenfolge gelesen und dann je
+        IN_BLOCK_GROESSE Zeilen in einer eigenen, kurzen Abfrage geholt.
+        """
+        sql, parameter = self._export_abfrage(jahrgang_id, spalten='s.id')
+        with self._lesen() as cur:
+            ids = [row['id'] for row in self._ausfuehren(cur, sql, parameter)]
+        for block in _in_bloecken(ids):
+            platzhalter = ','.join('?' * len(block))
+            with self._lesen() as cur:
+                zeilen = {row['id']: row for row in self._ausfuehren(cur, f'''
+                    SELECT {self.EXPORT_SPALTEN}
+                    FROM {{alle}} s
+                    JOIN {{jahrgaenge}} a ON s.jahrgang_id = a.id
+                    WHERE s.id IN ({platzhalter})
+                ''', block)}
+            # Zwischenzeitlich gelöschte Einträge fehlen einfach
+            for schueler_id in block:
+                if schueler_id in zeilen:
+                    yield zeilen[schueler_id]
+
+    def schema_aktualisieren(self):
+        with self._verbindung() as conn:
+            return schema.schema_aktualisieren(conn)
+
+    def vorwaermen(self):
+        # Datei einmal lesen, um den Seiten-Cache des Betriebssystems zu füllen
+        with open(self.pfad, 'rb') as datei:
+            gelesen = 0
+            while gelesen < MAX_VORWAERM_BYTES:
+                block = datei.read(1024 * 1024)
+                if not block:
+                    break
+                gelesen += len(block)
+
+
+#===========================================================
+#                        PostgreSQL
+#===========================================================
+class PostgresPool:
+    """
+    Thread-sicherer Pool mit fester Obergrenze.
+
+    ThreadedConnectionPool wirft bei Erschöpfung einen Fehler; das Semaphor
+    lässt weitere Anfragen stattdessen warten, bis eine Verbindung frei ist.
+    """
+
+    def __init__(self, dsn, min_verbindungen, max_verbindungen):
+        import psycopg2.pool
+        self._pool = psycopg2.pool.ThreadedConnectionPool(min_verbindungen, max_verbindungen, dsn)
+        self._frei = threading.BoundedSemaphore(max_verbindungen)
+
+    def holen(self):
+        self._frei.acquire()
+        try:
+            return self._pool.getconn()
+        except Exception:
+            self._frei.release()
+            raise
+
+    def zurueckgeben(self, conn):
+        try:
+            if not conn.closed:
+                conn.rollback()
+            self._pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._frei.release()
+
+    @contextlib.contextmanager
+    def verbindung(self):
+        conn = self.holen()
+        try:
+            yield conn
+        finally:
+            self.zurueckgeben(conn)
+
+    def schliessen(self):
+        self._pool.closeall()
+
+
+_postgres_pool = None
+_postgres_pool_lock = threading.Lock()
+
+
+def postgres_pool():
+    """Gemeinsamer PostgreSQL-Pool, beim ersten Zugriff erstellt"""
+    global _postgres_pool
+    with _postgres_pool_lock:
+        if _postgres_pool is None:
+            if not POSTGRES_DSN:
+                raise RuntimeError('SPEICHER=postgres benötigt POSTGRES_DSN')
+            _postgres_pool = PostgresPool(POSTGRES_DSN, POSTGRES_MIN_VERBINDUNGEN, POSTGRES_MAX_VERBINDUNGEN)
+        return _postgres_pool
+
+
+def postgres_schema(mandant=None):
+    """Schema des Mandanten, im Einzelbetrieb 'public'"""
+    if mandant:
+        if not mandanten.gueltiger_mandant(mandant):
+            raise ValueError(f'Ungültiger Mandantenname: {mandant!r}')
+        return POSTGRES_MANDANTEN_PRAEFIX + mandant
+    return 'public'
+
+
+class PostgresSpeicher(Speicher):
+    """Ein Schema je Mandant; Archiv als Tabelle schueler_daten_archiv"""
+
+    LIKE = 'ILIKE'
+    # Parallele Läufe mehrerer App-Server überspringen gesperrte Zeilen
+    SPERRE = ' FOR UPDATE SKIP LOCKED'
+    # CURRENT_TIMESTAMP in einer TIMESTAMP-Spalte wäre die Ortszeit der Sitzung
+    JETZT = "(now() AT TIME ZONE 'utc')"
+
+    def __init__(self, schema_name, pool=None):
+        import psycopg2
+        import psycopg2.extras
+        self._dict_cursor = psycopg2.extras.RealDictCursor
+        self.INTEGRITAETSFEHLER = (psycopg2.IntegrityError,)
+        self.pool = pool or postgres_pool()
+        # Mandantennamen sind auf [a-z0-9_-] beschränkt, Quoten genügt
+        self.schema = '"' + schema_name + '"'
+        self.tabellen = {
+            'jahrgaenge': f'{self.schema}.abitur_jahrgaenge',
+            'schueler': f'{self.schema}.schueler_daten',
+            'archiv': f'{self.schema}.schueler_daten_archiv',
+            'alle': f'{self.schema}.alle_schueler_daten',
+            'admins': f'{self.schema}.admins',
+            'protokoll': f'{self.schema}.aufbewahrung_protokoll',
+        }
+
+    def _sql(self, sql):
+        return super()._sql(sql).replace('?', '%s')
+
+    @contextlib.contextmanager
+    def _lesen(self):
+        with self.pool.verbindung() as conn:
+            with conn.cursor(cursor_factory=self._dict_cursor) as cur:
+                yield cur
+
+    @contextlib.contextmanager
+    def _transaktion(self):
+        with self.pool.verbindung() as conn:
+            try:
+                with conn.cursor(cursor_factory=self._dict_cursor) as cur:
+                    yield cur
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    @contextlib.contextmanager
+    def _export_cursor(self):
+        # Serverseitiger Cursor: Zeilen kommen in Blöcken, nicht alle auf einmal
+        with self.pool.verbindung() as conn:
+            with conn.cursor(name=f'export_{threading.get_ident()}_{time.monotonic_ns()}',
+                             cursor_factory=self._dict_cursor) as cur:
+                cur.itersize = EXPORT_ITERSIZE
+                yield cur
+
+    def schema_aktualisieren(self):
+        with self.pool.verbindung() as conn:
+            return schema.postgres_schema_aktualisieren(conn, self.schema)
+
+
+#===========================================================
+#                      Auswahl/Fabrik
+#===========================================================
+def erstellen(mandant=None):
+    """Speicher für einen Mandanten (None = Einzelbetrieb) nach SPEICHER"""
+    if SPEICHER == 'postgres':
+        return PostgresSpeicher(postgres_schema(mandant))
+    if SPEICHER == 'sqlite':
+        return SqliteSpeicher(sqlite_pfad(mandant))
+    raise RuntimeError(f'Unbekannter Speicher: {SPEICHER!r} (erlaubt: sqlite, postgres)')
+
+
+_postgres_mandanten = (0.0, frozenset())
+POSTGRES_MANDANTEN_CACHE_SEKUNDEN = 60
+
+
+def alle_mandanten():
+    """Alle eingerichteten Mandanten des gewählten Backends"""
+    if SPEICHER != 'postgres':
+        return mandanten.alle_mandanten()
+    with postgres_pool().verbindung() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT schema_name FROM information_schema.schemata WHERE schema_name LIKE %s',
+                        (POSTGRES_MANDANTEN_PRAEFIX.replace('_', r'\_') + '%',))
+            namen = [zeile[0][len(POSTGRES_MANDANTEN_PRAEFIX):] for zeile in cur.fetchall()]
+    return sorted(name for name in namen if mandanten.gueltiger_mandant(name))
+
+
+def mandant_existiert(name):
+    """Für die Middleware; bei PostgreSQL aus einem kurz gültigen Cache"""
+    global _postgres_mandanten
+    if SPEICHER != 'postgres':
+        return mandanten.mandant_existiert(name)
+    zeitpunkt, namen = _postgres_mandanten
+    if time.monotonic() - zeitpunkt > POSTGRES_MANDANTEN_CACHE_SEKUNDEN:
+        namen = frozenset(alle_mandanten())
+        _postgres_mandanten = (time.monotonic(), namen)
+    return name in namen
@@ -0,0 +1,294 @@
+"""
+Konformitäts- und Lastprüfung der Speicher-Backends.
+
+Führt dieselben Prüfungen gegen SQLite und/oder PostgreSQL aus und misst
+typische Massenoperationen. Gearbeitet wird in einer temporären Datei bzw.
+einem temporären Schema, das am Ende wieder entfernt wird.
+
+Beispiele:
+    python speicher_pruefung.py
+    python speicher_pruefung.py --backend beide --dsn postgresql://localhost/ehemalige
+    python speicher_pruefung.py --backend postgres --anzahl 50000
+"""
+
+import argparse
+import contextlib
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import archiv
+import aufbewahrung
+import mandanten
+import speicher
+from install import print_header, print_success, print_error, print_info
+
+
+class Pruefungsfehler(Exception):
+    """Ein Backend verhält sich anders als erwartet"""
+
+
+def pruefen(bedingung, text):
+    if not bedingung:
+        raise Pruefungsfehler(text)
+
+
+#===========================================================
+#                     Testumgebungen
+#===========================================================
+@contextlib.contextmanager
+def sqlite_speicher():
+    """Speicher in einem temporären Verzeichnis mit eigenem Pool"""
+    verzeichnis = tempfile.mkdtemp(prefix='speicher_pruefung_')
+    pool = mandanten.Verbindungspool(beim_oeffnen=archiv.anhaengen)
+    try:
+        yield speicher.SqliteSpeicher(os.path.join(verzeichnis, 'pruefung.db'), pool)
+    finally:
+        pool.schliessen()
+        shutil.rmtree(verzeichnis, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def postgres_speicher(dsn):
+    """Speicher in einem temporären Schema, das danach gelöscht wird"""
+    pool = speicher.PostgresPool(dsn, 1, 4)
+    schema_name = f'pruefung_{os.getpid()}'
+    try:
+        yield speicher.PostgresSpeicher(schema_name, pool)
+    finally:
+        with pool.verbindung() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f'DROP SCHEMA IF EXISTS "{schema_name}" CASCADE')
+            conn.commit()
+        pool.schliessen()
+
+
+#===========================================================
+#                    Konformitätsprüfung
+#===========================================================
+def konformitaet(db):
+    """Prüft das gemeinsame Verhalten aller Backends"""
+    db.schema_aktualisieren()
+    alt, neu = db.schema_aktualisieren()
+    pruefen(alt == neu, 'Zweite Migration muss ein No-op sein')
+
+    # Jahrgänge
+    db.jahrgang_hinzufuegen(2020)
+    db.jahrgang_hinzufuegen(2021)
+    try:
+        db.jahrgang_hinzufuegen(2021)
+        pruefen(False, 'Doppelter Jahrgang muss DoppelterEintrag auslösen')
+    except speicher.DoppelterEintrag:
+        pass
+    jahrgaenge = {j['jahrgang']: j['id'] for j in db.alle_jahrgaenge()}
+    pruefen(list(jahrgaenge) == [2021, 2020], 'alle_jahrgaenge absteigend sortiert')
+    alt_id, neu_id = jahrgaenge[2020], jahrgaenge[2021]
+    pruefen(db.jahrgang_finden(alt_id)['jahrgang'] == 2020, 'jahrgang_finden')
+    pruefen(db.jahrgang_finden(-1) is None, 'jahrgang_finden für unbekannte id')
+
+    # Schüler
+    for i in range(10):
+        db.schueler_hinzufuegen(alt_id if i < 6 else neu_id, f'Vor{i}', f'Muster{i}', f'v{i}@example.de')
+    pruefen(db.statistik()['total_schueler'] == 10, 'statistik zählt alle Einträge')
+    pruefen(len(db.schueler_liste()) == 10, 'schueler_liste')
+    pruefen(len(db.schueler_suchen('MUSTER')) == 10, 'Suche ignoriert Groß-/Kleinschreibung')
+    pruefen(len(db.schueler_suchen('v3@')) == 1, 'Suche nach E-Mail')
+
+    # Archiv
+    db.jahrgang_aktiv_setzen(alt_id, False)
+    pruefen(db.jahrgang_archivieren(alt_id, batch=4) == 6, 'Archivieren in Stapeln')
+    pruefen(len(db.schueler_liste()) == 4, 'Archivierte Zeilen fehlen in schueler_daten')
+    pruefen(db.statistik()['total_schueler'] == 10, 'statistik zählt archivierte Zeilen mit')
+    pruefen(not db.schueler_hinzufuegen(alt_id, 'Spät', 'Muster', 'spaet@example.de'),
+            'Kein neuer Eintrag in inaktiven Jahrgang')
+    pruefen(db.export_anzahl() == 10, 'Export enthält archivierte Zeilen')
+    uebersicht = {j['id']: j for j in db.jahrgaenge_uebersicht()}
+    pruefen(uebersicht[alt_id]['archiviert_anzahl'] == 6, 'jahrgaenge_uebersicht zählt Archiv')
+    pruefen(len(db.schueler_suchen('Muster')) == 10, 'Suche umfasst Archiv')
+    pruefen(db.jahrgang_archivieren(alt_id) == 0, 'Erneutes Archivieren verschiebt nichts')
+    db.jahrgang_aktiv_setzen(alt_id, True)
+    pruefen(db.jahrgang_wiederherstellen(alt_id, batch=4) == 6, 'Wiederherstellen')
+    db.jahrgang_archivieren(alt_id)
+    pruefen(db.aktive_wiederherstellen() == 6, 'Abgleich holt Archivzeilen aktiver Jahrgänge zurück')
+    db.jahrgang_aktiv_setzen(alt_id, False)
+    pruefen(db.inaktive_archivieren() == 6, 'inaktive_archivieren')
+
+    # Sammelaktionen
+    ids = sorted(z['id'] for z in db.schueler_suchen('Muster'))
+    pruefen(db.bulk('verschieben', ids[:2], neu_id)['betroffen'] == 2, 'Verschieben aus dem Archiv')
+    pruefen(len(db.schueler_liste()) == 6, 'Verschobene Zeilen liegen im aktiven Bereich')
+    pruefen(db.bulk('verschieben', ids[:3], neu_id) == {'betroffen': 1, 'unveraendert': 2, 'nicht_gefunden': 0},
+            'Bereits im Ziel-Jahrgang liegende Zeilen gelten als unverändert')
+    pruefen(db.export_anzahl() == 10, 'Verschieben verliert keine Zeilen')
+    einwilligung_vorher = {z['id']: z['datenschutz_datum'] for z in db.export_zeilen()}
+    pruefen(db.bulk('einwilligung_widerrufen', ids[:4])['betroffen'] == 4, 'Einwilligung widerrufen')
+    nachher = {z['id']: z for z in db.export_zeilen()}
+    pruefen(all(nachher[i]['widerrufen_am'] and nachher[i]['datenschutz_datum'] == einwilligung_vorher[i]
+                for i in ids[:4]),
+            'Widerruf setzt widerrufen_am und behält das Einwilligungsdatum')
+    # Stichtage werden in UTC berechnet, gespeicherte Zeitpunkte müssen es auch sein
+    in_einer_minute = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(minutes=1)
+    sofort = aufbewahrung.Regel('widerrufen', 0, 'loeschen').stichtag(in_einer_minute)
+    pruefen(sum(db.aufbewahrung_zaehlen(True, sofort, 'loeschen').values()) == 4,
+            'widerrufen:loeschen erfasst einen gerade erfolgten Widerruf (Zeitzone)')
+    pruefen(db.bulk('einwilligung_widerrufen', ids[:4]) == {'betroffen': 0, 'unveraendert': 4, 'nicht_gefunden': 0},
+            'Bereits widerrufene Einträge gelten als unverändert')
+    pruefen(db.bulk('loeschen', [ids[0], -1]) == {'betroffen': 1, 'unveraendert': 0, 'nicht_gefunden': 1},
+            'Löschen meldet unbekannte ids als nicht gefunden')
+    try:
+        db.bulk('unbekannt', ids)
+        pruefen(False, 'Unbekannte Aktion muss ValueError auslösen')
+    except ValueError:
+        pass
+
+    # Export
+    zeilen = list(db.export_zeilen())
+    pruefen(len(zeilen) == 9, 'export_zeilen liefert alle Zeilen')
+    pruefen([z['jahrgang'] for z in zeilen] == sorted((z['jahrgang'] for z in zeilen), reverse=True),
+            'Export nach Jahrgang sortiert')
+    widerrufen = sum(1 for z in zeilen if not z['datenschutz_einwilligung'])
+    pruefen(widerrufen == 3, 'Export enthält den Einwilligungsstatus')
+    pruefen(len(list(db.export_zeilen(alt_id))) == db.export_anzahl(alt_id), 'Export je Jahrgang')
+
+    # Aufbewahrung
+    stichtag = '9999-01-01 00:00:00'
+    faellig = db.aufbewahrung_zaehlen(True, stichtag, 'anonymisieren')
+    pruefen(sum(faellig.values()) == 3, 'Probelauf zählt widerrufene Einträge in beiden Bereichen')
+    bearbeitet = 0
+    for bereich in ('schueler', 'archiv'):
+        while True:
+            anzahl = db.aufbewahrung_stapel(bereich, 'pruefung', True, stichtag, 'anonymisieren', 2)
+            bearbeitet += anzahl
+            if anzahl < 2:
+                break
+    pruefen(bearbeitet == 3, 'Anonymisieren in Stapeln')
+    pruefen(sum(db.aufbewahrung_zaehlen(True, stichtag, 'anonymisieren').values()) == 0,
+            'Anonymisierte Einträge sind nicht mehr fällig')
+    pruefen(len(db.aufbewahrung_protokoll()) == 3, 'Protokoll je bearbeitetem Eintrag')
+    pruefen(sum(1 for z in db.export_zeilen() if z['email'] == '') == 3, 'Anonymisierte Einträge bleiben erhalten')
+    pruefen(db.aufbewahrung_zaehlen(True, '2000-01-01 00:00:00', 'loeschen') == {'schueler': 0, 'archiv': 0},
+            'Stichtag begrenzt die Auswahl')
+
+    # Admins
+    db.admin_anlegen_falls_fehlend('admin', 'hash1')
+    db.admin_anlegen_falls_fehlend('admin', 'anders')
+    pruefen(db.admin_anmelden('admin', 'hash1') is not None, 'Standard-Admin wird nicht überschrieben')
+    db.admin_hinzufuegen('zweiter', 'hash2')
+    try:
+        db.admin_hinzufuegen('zweiter', 'hash3')
+        pruefen(False, 'Doppelter Benutzer muss DoppelterEintrag auslösen')
+    except speicher.DoppelterEintrag:
+        pass
+    zweiter = next(a for a in db.admins() if a['benutzername'] == 'zweiter')
+    pruefen(db.admin_passwort_aendern(zweiter['id'], 'falsch', 'neu') is None, 'Falsches altes Passwort')
+    pruefen(db.admin_passwort_aendern(zweiter['id'], 'hash2', 'neu') == 'zweiter', 'Passwort ändern')
+    pruefen(db.admin_anmelden('zweiter', 'neu') is not None, 'Anmeldung mit neuem Passwort')
+    db.admin_loeschen(zweiter['id'])
+    pruefen(db.admin_anzahl() == 1 and db.admin_vorhanden(), 'Admin löschen')
+
+    # Schreiben während eines laufenden (langsamen) Exports
+    export = db.export_zeilen()
+    next(export)
+    pruefen(db.schueler_hinzufuegen(neu_id, 'Während', 'Export', 'export@example.de'),
+            'Eintragen während eines offenen Exports')
+    export.close()
+
+    # Aufräumen über den Jahrgang
+    erwartet = db.export_anzahl(alt_id)
+    pruefen(db.jahrgang_loeschen(alt_id) == erwartet, 'jahrgang_loeschen zählt aktive und archivierte Zeilen')
+    pruefen(db.jahrgang_finden(alt_id) is None, 'Jahrgang gelöscht')
+    db.jahrgang_loeschen(neu_id)
+    pruefen(db.export_anzahl() == 0, 'Alle Daten entfernt')
+
+
+#===========================================================
+#                       Lastmessung
+#===========================================================
+@contextlib.contextmanager
+def messen(ergebnisse, name):
+    start = time.perf_counter()
+    yield
+    ergebnisse.append((name, time.perf_counter() - start))
+
+
+def last(db, anzahl):
+    """Misst Massenoperationen mit anzahl Einträgen; gibt [(name, sekunden)] zurück"""
+    ergebnisse = []
+    db.jahrgang_hinzufuegen(1990)
+    db.jahrgang_hinzufuegen(1991)
+    jahrgaenge = {j['jahrgang']: j['id'] for j in db.alle_jahrgaenge()}
+    jahrgang_id = jahrgaenge[1990]
+
+    with messen(ergebnisse, f'{anzahl} Einträge einfügen'):
+        for i in range(anzahl):
+            db.schueler_hinzufuegen(jahrgang_id, f'Vor{i}', f'Nach{i}', f'n{i}@example.de')
+    with messen(ergebnisse, 'Suche'):
+        db.schueler_suchen('Nach12')
+    with messen(ergebnisse, 'Export (gestreamt)'):
+        for _ in db.export_zeilen():
+            pass
+    ids = [z['id'] for z in db.schueler_liste()]
+    with messen(ergebnisse, 'Sammelaktion: Einwilligung widerrufen'):
+        db.bulk('einwilligung_widerrufen', ids)
+    with messen(ergebnisse, 'Sammelaktion: verschieben'):
+        db.bulk('verschieben', ids, jahrgaenge[1991])
+    db.jahrgang_aktiv_setzen(jahrgaenge[1991], False)
+    with messen(ergebnisse, 'Jahrgang archivieren'):
+        db.jahrgang_archivieren(jahrgaenge[1991])
+    db.jahrgang_aktiv_setzen(jahrgaenge[1991], True)
+    with messen(ergebnisse, 'Jahrgang wiederherstellen'):
+        db.jahrgang_wiederherstellen(jahrgaenge[1991])
+    with messen(ergebnisse, 'Jahrgang löschen'):
+        db.jahrgang_loeschen(jahrgaenge[1991])
+    return ergebnisse
+
+
+def backend_pruefen(name, umgebung, anzahl):
+    """Konformität und Last für ein Backend; gibt True bei Erfolg zurück"""
+    print_header(f"SPEICHER: {name.upper()}")
+    try:
+        with umgebung() as db:
+            konformitaet(db)
+            print_success("Konformitätsprüfung bestanden")
+            if anzahl:
+                for messung, sekunden in last(db, anzahl):
+                    print(f"   {messung:<42} {sekunden * 1000:>9.1f} ms")
+        return True
+    except Pruefungsfehler as e:
+        print_error(f"Abweichung: {e}")
+    except Exception as e:
+        print_error(f"Fehler: {e!r}")
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Konformitäts- und Lastprüfung der Speicher-Backends")
+    parser.add_argument('--backend', choices=('sqlite', 'postgres', 'beide'), default='sqlite')
+    parser.add_argument('--dsn', default=speicher.POSTGRES_DSN,
+                        help="PostgreSQL-Verbindung (Standard: POSTGRES_DSN)")
+    parser.add_argument('--anzahl', type=int, default=2000,
+                        help="Einträge für die Lastmessung, 0 = nur Konformität")
+    args = parser.parse_args()
+
+    backends = []
+    if args.backend in ('sqlite', 'beide'):
+        backends.append(('sqlite', sqlite_speicher))
+    if args.backend in ('postgres', 'beide'):
+        if not args.dsn:
+            print_error("Für PostgreSQL --dsn oder POSTGRES_DSN angeben")
+            sys.exit(2)
+        backends.append(('postgres', lambda: postgres_speicher(args.dsn)))
+
+    fehlgeschlagen = [name for name, umgebung in backends
+                      if not backend_pruefen(name, umgebung, args.anzahl)]
+    if fehlgeschlagen:
+        print_error(f"Fehlgeschlagen: {', '.join(fehlgeschlagen)}")
+        sys.exit(1)
+    print_info("Alle Backends verhalten sich gleich.")
+
+
+if __name__ == "__main__":
+    main()
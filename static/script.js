@@ -11,8 +11,8 @@ function makeSortable(table) {
     const headers = table.querySelectorAll('th');
     
     headers.forEach((header, index) => {
-        // Skip Aktionen-Spalte
-        if (header.textContent.trim() === 'Aktionen') return;
+        // Skip Aktionen-Spalte und Auswahl-Spalte
+        if (header.textContent.trim() === 'Aktionen' || header.classList.contains('no-sort')) return;
         
         header.style.cursor = 'pointer';
         header.style.userSelect = 'none';
@@ -110,4 +110,44 @@ function initMobileTables() {
 }
 
 // Bei Seitenload Mobile-Optimierungen anwenden
-document.addEventListener('DOMContentLoaded', initMobileTables);
\ No newline at end of file
+document.addEventListener('DOMContentLoaded', initMobileTables);
+
+// Mehrfachauswahl und Sammelaktionen im Dashboard
+function initBulkActions() {
+    const form = document.getElementById('bulk-form');
+    if (!form) return;
+    
+    const alle = document.getElementById('bulk-alle');
+    const checkboxes = document.querySelectorAll('.bulk-checkbox');
+    const aktion = document.getElementById('bulk-aktion');
+    const ziel = document.getElementById('bulk-ziel');
+    const submit = document.getElementById('bulk-submit');
+    const anzahl = document.getElementById('bulk-anzahl');
+    
+    function aktualisieren() {
+        const ausgewaehlt = document.querySelectorAll('.bulk-checkbox:checked').length;
+        anzahl.textContent = ausgewaehlt;
+        alle.checked = ausgewaehlt > 0 && ausgewaehlt === checkboxes.length;
+        ziel.disabled = aktion.value !== 'verschieben';
+        submit.disabled = ausgewaehlt === 0 || !aktion.value;
+    }
+    
+    alle.addEventListener('change', () => {
+        checkboxes.forEach(checkbox => { checkbox.checked = alle.checked; });
+        aktualisieren();
+    });
+    checkboxes.forEach(checkbox => checkbox.addEventListener('change', aktualisieren));
+    aktion.addEventListener('change', aktualisieren);
+    
+    form.addEventListener('submit', event => {
+        const ausgewaehlt = document.querySelectorAll('.bulk-checkbox:checked').length;
+        if (aktion.value === 'loeschen' &&
+            !confirm(`Sind Sie sicher, dass Sie ${ausgewaehlt} Einträge löschen möchten?`)) {
+            event.preventDefault();
+        }
+    });
+    
+    aktualisieren();
+}
+
+document.addEventListener('DOMContentLoaded', initBulkActions);
\ No newline at end of file